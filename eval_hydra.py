@@ -4,18 +4,25 @@ import cv2
 import json
 import time
 import os
+import sys
 import random
+import argparse
+from collections import deque
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 import matplotlib.pyplot as plt
 
-from src.HydraPose import HydraPose, SEFFPOSE
+from src.HydraPose import HydraPose, SEFFPOSE, addModelArguments, modelOptions
 from src.SkeletonsBridge import SkeletonsBridge
 from src.Fusion import Fusion
 from src.Visualizer import Visualizer
+from src.Deproject import deprojectKeypointsFromDepth
+from src.ResultStore import ResultStore
+from src.Metrics import matchPersons, RunningMetrics
 bridge = SkeletonsBridge()
 
 
-import sys
 sys.path.insert(0, '/home/guisoares/soares_repo/MVOR/lib/')
 
 from visualize_groundtruth import create_index, viz2d, plt_imshow, bgr2rgb, plt_3dplot, coco_to_camma_kps, progress_bar
@@ -42,50 +49,47 @@ def getCamDistFromDataset(data_dict, id):
     dist = np.array(data_dict['cameras_info']['camParams']['intrinsics'][id]['distortion'])
     return dist
 
-def getPersonMediumDist(person1, person2):
+def getMinimalDist(persons_est, persons_annon):
 
-    error_per_joint = []
-    for kpt1, kpt2 in zip(person1, person2):
-        error = np.sqrt(np.sum(np.power(kpt1 - kpt2, 2)))
-        error_per_joint.append(error)
-    
-    error_per_joint = np.array(error_per_joint)
-    mean = np.mean(error_per_joint)
-    return mean, error_per_joint
+    # Optimal one-to-one matching of the estimates to the annotations (see
+    # src/Metrics.py). Returns the matched estimates and annotations, the
+    # mean error of each matched person and its per-joint errors.
+    est_idx, ann_idx, error_per_joint_arr = matchPersons(persons_est, persons_annon)
 
-def getMinimalDist(persons_est, persons_annon):
+    present = ~np.isnan(error_per_joint_arr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_error_per_joint_arr = np.where(present, error_per_joint_arr, 0).sum(axis=1) / present.sum(axis=1)
 
-    # Store
-    min_index_list = []
-    min_error_per_joint_list = []
-    min_mean_error_per_joint_list = []
-    # Get the annotation index that results the minimal mean error
-    for person_est in persons_est:
-        mean_error_list = []
-        error_per_joint_list = []
-        for person_annon in persons_annon:
-            mean_error, error_per_joint = getPersonMediumDist(person_est, person_annon)
-            mean_error_list.append(mean_error)
-            error_per_joint_list.append(error_per_joint)
-        # Get the index of the minimum error and insert on a list that contains it 
-        min_index = np.argmin(mean_error_list)
-        min_index_list.append(min_index)
-        min_error_per_joint_list.append(error_per_joint_list[min_index])
-        min_mean_error_per_joint_list.append(mean_error_list[min_index])
-    
-    # Certifie that index list has diferent elements, meaning that no estimation has the same annotation
-    
-    # _, count = np.unique(min_index_list, return_counts = True)
-    # for c in count:
-    #     if c != 1:
-    #         raise AssertionError("The mapped index list has duplicated elements")
-
-    # Remap annotation to
-    persons_annon_remapped = persons_annon[min_index_list]
-    min_mean_error_per_joint_arr = np.array(min_mean_error_per_joint_list)
-    min_error_per_joint_arr = np.array(min_error_per_joint_list)
-    min_error_per_joint_arr = np.reshape(min_error_per_joint_arr, (-1,10))
-    return persons_est, persons_annon_remapped, min_mean_error_per_joint_arr, min_error_per_joint_arr
+    persons_est = np.reshape(persons_est, (-1,) + persons_annon.shape[1:])
+    return persons_est[est_idx], persons_annon[ann_idx], mean_error_per_joint_arr, error_per_joint_arr
+
+class LazyFrames:
+
+    # Images of the cameras of a multi-view sample, each decoded on first
+    # access (frames[cam]) or in the background once prefetched
+
+    def __init__(self, paths, flags = cv2.IMREAD_COLOR):
+        self.paths = paths
+        self.flags = flags
+        self.images = [None] * len(paths)
+        self.futures = [None] * len(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, cam):
+        if self.images[cam] is None:
+            if self.futures[cam] is not None:
+                self.images[cam] = self.futures[cam].result()
+            else:
+                self.images[cam] = cv2.imread(self.paths[cam], self.flags)
+        return self.images[cam]
+
+    def prefetch(self, cams, executor):
+        # cv2.imread releases the GIL, so decoding overlaps with inference
+        for cam in cams:
+            if self.images[cam] is None and self.futures[cam] is None:
+                self.futures[cam] = executor.submit(cv2.imread, self.paths[cam], self.flags)
 
 def getAnnotations(GT_IMGS_PATH, imid_3d, imid_to_path, anno_2d, anno_3d, cam):
 
@@ -116,8 +120,9 @@ def getAnnotations(GT_IMGS_PATH, imid_3d, imid_to_path, anno_2d, anno_3d, cam):
     rgb_paths = [imid_to_path[img_id] for img_id in imids_2d]
     depth_paths = [rgb_path.replace('color', 'depth') for rgb_path in rgb_paths]
 
-    rgb_imgs = [cv2.imread(os.path.join(GT_IMGS_PATH, rgb_path)) for rgb_path in rgb_paths]
-    depth_imgs = [cv2.imread(os.path.join(GT_IMGS_PATH, depth_path), cv2.IMREAD_UNCHANGED) for depth_path in depth_paths]
+    # Only the views that are accessed get decoded
+    rgb_imgs = LazyFrames([os.path.join(GT_IMGS_PATH, rgb_path) for rgb_path in rgb_paths])
+    depth_imgs = LazyFrames([os.path.join(GT_IMGS_PATH, depth_path) for depth_path in depth_paths], cv2.IMREAD_UNCHANGED)
 
     return rgb_imgs, depth_imgs, persons2D_ann, persons3D_ann
 
@@ -128,45 +133,34 @@ def runHydraSeffPose(imgs, cam, camma_mvor_gt):
     persons = hy.estimate3DPose(imgs[0])
     if len(persons)==0:
         return np.array([])
-    persons_aux = np.zeros((persons.shape[0],10,3))
-    for idx, person in enumerate(persons):
-        persons_aux[idx] = bridge.HM36MtoMVOR(person)
+    persons_aux = bridge.transformPersonsFromTo(persons, 'HM36M', 'MVOR')
     
     return persons_aux
 
 def getPersonFromDepth(cam_mtx, depth_img, person2D):
-    # Get focal distances
-    fx = cam_mtx[0][0]
-    fy = cam_mtx[1][1]
     
-    # Get principal points
-    cx = cam_mtx[0][2]
-    cy = cam_mtx[1][2]
-
-    person_stereo = np.zeros((person2D.shape[0],3))
-    for idx, [u,v] in enumerate(person2D):
-        u, v = int(u), int(v)
-        depth = depth_img[v][u]
-        if depth <= 0:
-            person_stereo[idx] = [-1, -1, -1]
-        else:
-            x = depth*(u - cx)/fx
-            y = depth*(v - cy)/fy
-            z = depth
-            person_stereo[idx] = [x, y, z]
-    
-    person_stereo = bridge.HM36MtoMVOR(person_stereo)
+    person_stereo, _ = deprojectKeypointsFromDepth(person2D[np.newaxis], depth_img, cam_mtx)
+    person_stereo = bridge.HM36MtoMVOR(person_stereo[0])
         
     return person_stereo
 
-def runHydra(rgb_imgs, depth_imgs, cam, camma_mvor_gt):
-    hy = HydraPose(pose3D = SEFFPOSE)
-    fus = Fusion()
-    
+def runHydra(rgb_imgs, depth_imgs, cam, camma_mvor_gt, hy = None, fus = None):
+
+    # hy and fus can be reused across samples (see initWorker), otherwise
+    # they are built for this call
     cam_mtx = getCamMtxFromDataset(camma_mvor_gt,0)
-    # SeffPose
-    # hy.setIntrinsics(getCamMtxFromDataset(camma_mvor_gt,0),getCamDistFromDataset(camma_mvor_gt,0))
-    hy.setIntrinsics(cam_mtx, np.array([0.,0.,0.,0.,0.]))
+    if hy is None:
+        hy = HydraPose(pose3D = SEFFPOSE)
+        # SeffPose
+        # hy.setIntrinsics(getCamMtxFromDataset(camma_mvor_gt,0),getCamDistFromDataset(camma_mvor_gt,0))
+        hy.setIntrinsics(cam_mtx, np.array([0.,0.,0.,0.,0.]))
+    if fus is None:
+        fus = Fusion()
+
+    # Samples are unrelated stills: solvePnP must not warm start from the
+    # previous sample, or the errors would depend on the sample order
+    hy.deproj.resetWarmStart()
+    
     persons = hy.estimate3DPose(rgb_imgs[0])
     
     # Checking number of persons
@@ -175,19 +169,14 @@ def runHydra(rgb_imgs, depth_imgs, cam, camma_mvor_gt):
         return np.array([])
     
     # From HM36M to MVOR
-    persons_seff = np.zeros((persons.shape[0], 10, 3))
-    for idx, person in enumerate(persons):
-        persons_seff[idx] = bridge.HM36MtoMVOR(person)
+    persons_seff = bridge.transformPersonsFromTo(persons, 'HM36M', 'MVOR')
     
     # StereoPose
-    persons_stereo = np.zeros((persons.shape[0], 10, 3))
-    for idx, person2D in enumerate(hy.persons2D):
-        persons_stereo[idx] = getPersonFromDepth(cam_mtx, depth_imgs[0], person2D)
+    persons_stereo, _ = deprojectKeypointsFromDepth(hy.persons2D, depth_imgs[0], cam_mtx)
+    persons_stereo = bridge.transformPersonsFromTo(persons_stereo, 'HM36M', 'MVOR')
     
-    # Fusion
-    persons_hy = np.zeros((persons.shape[0], 10, 3))
-    for idx in range(len(persons_stereo)):
-        persons_hy[idx] = fus.mergeResults(persons_stereo[idx], persons_seff[idx], thresh = 700)
+    # Fusion (missing depth keeps the [-1, -1, -1] sentinel)
+    persons_hy, _ = fus.mergeResultsBatch(persons_stereo, persons_seff, thresh = 700)
     
     return persons_hy
 
@@ -229,24 +218,109 @@ def comparePlot3D(img, persons_hy, persons_ann):
 
     return fig
 
-def saveCurrState(mean_error, error_per_joint):
+def openResultStore(name='mvor_hydra', workers = 1):
+
+    # One store per run, named after the configuration and start time
+    path = os.path.join('results', f"{name}_{time.strftime('%Y%m%d-%H%M%S')}")
+    metadata = {'dataset': 'MVOR', 'pose3D': 'SEFFPOSE+stereo', 'fusion_thresh': 700, 'skeleton': 'MVOR',
+                'workers': workers}
+    print(f'Saving results to {path}')
+    return ResultStore(path, mode='w', num_joints=10, metadata=metadata)
+
+# Evaluation state of the current process, set once by initWorker so the
+# models are loaded once per process instead of once per sample
+_worker = {}
+
+def initWorker(gt_imgs_path, camma_mvor_gt, index, threads = None, pose2D_options = None, pose3D_options = None):
+
+    # threads caps the torch/OpenCV pools of each process, so a pool of
+    # workers does not oversubscribe the cores
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+
+    hy = HydraPose(pose3D = SEFFPOSE, headless = True, pose2D_options = pose2D_options, pose3D_options = pose3D_options)
+    hy.setIntrinsics(getCamMtxFromDataset(camma_mvor_gt,0), np.array([0.,0.,0.,0.,0.]))
+
+    # Decoding threads of the image prefetcher
+    executor = ThreadPoolExecutor(2)
+
+    _worker.update(hy=hy, fus=Fusion(), gt_imgs_path=gt_imgs_path, camma_mvor_gt=camma_mvor_gt, index=index,
+                   executor=executor)
+
+def prefetchSamples(shard, ahead = 2, cams = (0,)):
+
+    # Yields (i, imid_3d, annotations) of the shard in order while the
+    # views of the next `ahead` samples decode in the background
+    anno_2d, anno_3d, _, imid_to_path = _worker['index']
+
+    loaded = deque()
+    for i, imid_3d in shard:
+        sample = getAnnotations(_worker['gt_imgs_path'], imid_3d, imid_to_path, anno_2d, anno_3d, 0)
+        # Samples without 3D annotation are skipped, nothing to decode
+        if sample[3].shape[0] > 0:
+            sample[0].prefetch(cams, _worker['executor'])
+            sample[1].prefetch(cams, _worker['executor'])
+        loaded.append((i, imid_3d, sample))
+        if len(loaded) > ahead:
+            yield loaded.popleft()
+
+    while loaded:
+        yield loaded.popleft()
+
+def evaluateSample(i, imid_3d, sample, viz = False):
+
+    # (i, sample id, persons, mean errors, errors per joint, number of
+    # estimates and annotations, elapsed) or None for a sample without
+    # annotation
+    start = time.time()
+    rgb_imgs, depth_imgs, persons2D_ann, persons3D_ann = sample
+
+    if persons3D_ann.shape[0] == 0:
+        return None
+
+    persons = runHydra(rgb_imgs, depth_imgs, 0, _worker['camma_mvor_gt'], hy=_worker['hy'], fus=_worker['fus'])
+
+    # Simulating plots from annontations
+    # simulateAnnonPlot(imgs, persons2D_ann, persons3D_ann)
+
+    num_est, num_ann = len(persons), len(persons3D_ann)
+    persons, persons3D_ann, mean_error_per_joint_arr, error_per_joint_arr = getMinimalDist(persons, persons3D_ann)
 
-    t = time.localtime()
-    day = t.tm_mday
-    month = t.tm_mon
-    hour = t.tm_hour
-    mins = t.tm_min
-    print(f'Finished evaluating at time {day}/{month}-{hour}:{mins}')
+    elapsed_time = time.time() - start
 
-    path = os.path.join('results_tmp',f'mean_error_{day}-{month}_{hour}:{mins}.npy')
-    with open(path, 'wb') as f:
-        np.save(f, mean_error)
+    if viz:
+        comparePlot3D(rgb_imgs[0], persons, persons3D_ann)
+        input()
 
-    path = os.path.join('results_tmp',f'error_per_joint_{day}-{month}_{hour}:{mins}.npy')
-    with open(path, 'wb') as f:
-        np.save(f, error_per_joint)
+    # Sample id is the id of the first camera image
+    return (i, int(imid_3d.split("_")[0]), persons, mean_error_per_joint_arr, error_per_joint_arr,
+            num_est, num_ann, elapsed_time)
 
-def main(viz=False):
+def newMetrics():
+    return RunningMetrics(10, pck_thresholds=(100, 150))
+
+def evaluateShard(shard, viz = False):
+
+    # shard is a list of (i, imid_3d). Returns the per-sample results and
+    # the metrics of the shard, merged by the caller.
+    results = [evaluateSample(i, imid_3d, sample, viz) for i, imid_3d, sample in prefetchSamples(shard)]
+
+    metrics = newMetrics()
+    for result in results:
+        if result is not None:
+            _, _, _, _, error_per_joint_arr, num_est, num_ann, _ = result
+            metrics.update(error_per_joint_arr, num_est, num_ann)
+
+    return results, metrics
+
+def makeShards(imids_3d, shard_size):
+    # Contiguous slices of the sample list, numbered by sample position
+    samples = list(enumerate(imids_3d))
+    return [samples[k:k + shard_size] for k in range(0, len(samples), shard_size)]
+
+def main(viz=False, workers=None, shard_size=8, pose2D_options=None, pose3D_options=None):
 
     GT_ANNO_PATH = os.path.join(os.path.expanduser('~'), "soares_repo", "MVOR", "annotations/camma_mvor_2018.json")
     GT_IMGS_PATH = '/media/guisoares/guisoares-ext-hdd/Datasets/camma_mvor_dataset/'
@@ -254,64 +328,75 @@ def main(viz=False):
     # load the ground truth annotations
     camma_mvor_gt = json.load(open(GT_ANNO_PATH))
 
-    anno_2d, anno_3d, mv_paths, imid_to_path = create_index(camma_mvor_gt)
+    index = create_index(camma_mvor_gt)
+    mv_paths = index[2]
 
     imids_3d = list(mv_paths.keys())
     len_ids = len(imids_3d)
 
-    mean_error = np.empty((0))
-    error_per_joint = np.empty((0,10))
+    # Plotting needs the main process
+    workers = 1 if viz else (workers or os.cpu_count())
+    threads = max(1, os.cpu_count() // workers)
+    shards = makeShards(imids_3d, shard_size)
+
+    store = openResultStore(workers=workers)
+    metrics = newMetrics()
+    done = 0
+    skipped = 0
 
-    elapsed_time = 0
     # id with 2 persons but only one annon: '10010000005_10020000005_10030000005'
+    pool = None
+    run_start = time.time()
     try:
-        for i, imid_3d in enumerate(imids_3d):
-            os.system('clear')
-            print(f"Status: i = {i} total = {len_ids} progress = {round((i*100)/len_ids,3)}%")
-            print(f"Last elapsed time: {round(elapsed_time,1)} s. Estimated time: {round((len_ids-i)*elapsed_time/3600,2)} h.")
-            print(f"Current mean error {mean_error.mean()}")
-            print(f"Evaluating id={imid_3d}...")
-
-            start = time.time()
-            rgb_imgs, depth_imgs, persons2D_ann, persons3D_ann = getAnnotations(GT_IMGS_PATH, imid_3d, imid_to_path, anno_2d, anno_3d, 0)
-
-            if persons3D_ann.shape[0] == 0:
-                print("No annotation, going to next id...")
-                continue
-
-            persons = runHydra(rgb_imgs, depth_imgs, 0, camma_mvor_gt)
-            
-            if persons.shape[0] == 0:
-                print("No estimatives, going to next id...")
-            
-            # Simulating plots from annontations
-            print(persons3D_ann.shape)
-            # simulateAnnonPlot(imgs, persons2D_ann, persons3D_ann)
-
-            # Comparing the results
-            # fig = comparePlot3D(imgs[0], persons, persons3D_ann)
-
-            persons, persons3D_ann, mean_error_per_joint_arr, error_per_joint_arr = getMinimalDist(persons, persons3D_ann)
-            
-            mean_error = np.hstack((mean_error, mean_error_per_joint_arr))
-            error_per_joint = np.vstack((error_per_joint, error_per_joint_arr))
-            print(error_per_joint_arr)
-            print(mean_error_per_joint_arr)
-
-            elapsed_time = time.time() - start
-
-            # input()
-            # plt.close(fig)
-            # input()
-            if viz:
-                comparePlot3D(rgb_imgs[0], persons, persons3D_ann)
-                input()
-        
-        saveCurrState(mean_error, error_per_joint)
+        if workers > 1:
+            pool = Pool(workers, initializer=initWorker, initargs=(GT_IMGS_PATH, camma_mvor_gt, index, threads,
+                                                                     pose2D_options, pose3D_options))
+            # Shards come back in completion order, records keep their sample position
+            results = pool.imap_unordered(evaluateShard, shards)
+        else:
+            initWorker(GT_IMGS_PATH, camma_mvor_gt, index, pose2D_options=pose2D_options, pose3D_options=pose3D_options)
+            results = (evaluateShard(shard, viz) for shard in shards)
+
+        for shard_results, shard_metrics in results:
+            metrics.merge(shard_metrics)
+            for result in shard_results:
+                done += 1
+                if result is None:
+                    skipped += 1
+                    continue
+
+                i, sample, persons, mean_error_per_joint_arr, error_per_joint_arr, num_est, num_ann, elapsed_time = result
+                store.appendFrame(i, sample, persons3D=persons, errors=mean_error_per_joint_arr,
+                                  error_per_joint=error_per_joint_arr, elapsed=elapsed_time)
+
+            # One status line, rewritten in place
+            rate = done / (time.time() - run_start)
+            print(f"\r{done}/{len_ids} ({100 * done / len_ids:.1f}%) {rate:.2f} samples/s, "
+                  f"ETA {(len_ids - done) / rate / 60:.1f} min, MPJPE {metrics.mpjpe:.1f} mm",
+                  end='', flush=True)
+        print()
 
     finally:
-        saveCurrState(mean_error, error_per_joint)
-        print(f"Saved array. Quiting.")
+        if pool is not None:
+            pool.terminate()
+        store.close()
+        print(f"Saved {len(store)} results to {store.path}. Quiting.")
+
+    # Report merged over all shards
+    elapsed = time.time() - run_start
+    print(f"Evaluated {done - skipped} samples ({skipped} without annotation) in {elapsed / 60:.1f} min "
+          f"with {workers} workers, {done / elapsed:.2f} samples/s")
+    print(metrics.report())
 
 if __name__ == '__main__':
-    main(viz=False)
+
+    parser = argparse.ArgumentParser(description="HydraPose evaluation on the MVOR multi-view samples.")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument('--shard-size', type=int, default=8, help="samples per work unit")
+    parser.add_argument('--viz', action='store_true', help="plot every sample (single process)")
+    addModelArguments(parser)
+    args = parser.parse_args()
+    pose2D_options, pose3D_options = modelOptions(args)
+
+    main(viz=args.viz, workers=args.workers, shard_size=args.shard_size,
+         pose2D_options=pose2D_options, pose3D_options=pose3D_options)
@@ -1,20 +1,28 @@
 import numpy as np
 import os
+import sys
 
-path = os.path.join('results_tmp','mean_error_12-5_10:39.npy')
+from src.ResultStore import ResultStore
 
-with open(path, 'rb') as f:
-    mean_error = np.load(f)
+# Store to analyse: given as argument, otherwise the latest run in results/
+if len(sys.argv) > 1:
+    path = sys.argv[1]
+else:
+    runs = [os.path.join('results', name) for name in os.listdir('results')
+            if os.path.isfile(os.path.join('results', name, 'index.json'))]
+    path = max(runs, key=os.path.getmtime)
 
-print(f"Analysing {mean_error.shape[0]} annotations:")
+store = ResultStore(path)
+print(f"Run {path}: {store.metadata}")
 
-print(f"Mean error: {np.mean(mean_error)} mm")
+mean_error = store.column('error')
+mean_error = mean_error[~np.isnan(mean_error)]
 
+print(f"Analysing {mean_error.shape[0]} annotations:")
 
-path = os.path.join('results_tmp','error_per_joint_12-5_10:39.npy')
+print(f"Mean error: {np.mean(mean_error)} mm")
 
-with open(path, 'rb') as f:
-    error_per_joint = np.load(f)
+error_per_joint = store.column('error_per_joint')
 
 print(f"Mean Error Per Joint:")
-print(np.mean(error_per_joint, axis=0))
+print(np.nanmean(error_per_joint, axis=0))
@@ -1,32 +1,90 @@
-from src.HydraPose import HydraPose, SEFFPOSE, FULL
+from src.HydraPose import HydraPose, SEFFPOSE, FULL, BLOCK, addModelArguments, modelOptions
+from src.ResultStore import ResultStore
+from functools import partial
+import argparse
+import time
 import os
 import cv2
 import numpy as np
 
-hy = HydraPose(pose3D=FULL)
-
 path = "/media/guisoares/guisoares-ext-hdd/Surgery-Records"
 fn = "20211208_141701.bag"
 
-abs_path = os.path.join(path,fn)
+def processSegment(abs_path, start, end, stride = 1, threads = None, pose2D_options = None, pose3D_options = None):
+
+    # Offline worker: one headless HydraPose per process, results of the
+    # segment go to their own store. threads caps the torch/OpenCV pools of
+    # the process, so parallel segments do not oversubscribe the cores.
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+
+    hy = HydraPose(pose3D=FULL, headless=True, pose2D_options=pose2D_options, pose3D_options=pose3D_options)
+    hy.initRealSenseBag(abs_path, stride=stride, start=start, end=end)
+
+    name = os.path.splitext(os.path.basename(abs_path))[0]
+    store = ResultStore(os.path.join('results', f"{name}_{int(start)}-{int(end)}s"), mode='w',
+                        metadata={'bag': abs_path, 'start': start, 'end': end, 'stride': stride})
+    frame = 0
+    with store:
+        while True:
+            frames = hy.getRealSenseBagFrames()
+            if frames is None:
+                break
+            t0 = time.time()
+            persons3D = hy.estimate3DPose(*frames)
+            if len(persons3D) > 0:
+                store.appendFrame(frame, hy.rlsns.bag.frame_index, persons2D=hy.persons2D, persons3D=persons3D,
+                                  fusion_flags=hy.fusion_flags, elapsed=time.time() - t0)
+            frame += 1
+
+    return store.path, frame
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="3D pose estimation on a RealSense recording.")
+    parser.add_argument('--bag', default=os.path.join(path, fn))
+    parser.add_argument('--stride', type=int, default=1, help="process one frame out of stride")
+    parser.add_argument('--start', type=float, default=None, help="start time (s)")
+    parser.add_argument('--end', type=float, default=None, help="end time (s)")
+    parser.add_argument('--cache', default=None,
+                        help="read frames from a cache made by tools/extract_bag_frames.py instead of the bag")
+    parser.add_argument('--segments', type=int, default=0,
+                        help="process the bag offline in this many parallel time segments")
+    addModelArguments(parser)
+    args = parser.parse_args()
+    pose2D_options, pose3D_options = modelOptions(args)
 
-hy.initRealSenseBag(abs_path)
+    if args.segments > 0:
+        # librealsense is only needed here and for bag playback, not for caches
+        from src.BagReader import processBagInParallel
 
-hy.initWindow()
+        threads = max(1, os.cpu_count() // args.segments)
+        results = processBagInParallel(args.bag, partial(processSegment, stride=args.stride, threads=threads,
+                                                               pose2D_options=pose2D_options, pose3D_options=pose3D_options),
+                                       processes=args.segments, start=args.start, end=args.end)
+        for store_path, frames in results:
+            print(f"{store_path}: {frames} frames")
+    else:
+        hy = HydraPose(pose3D=FULL, pose2D_options=pose2D_options, pose3D_options=pose3D_options)
 
-while True:
+        if args.cache is not None:
+            hy.initFrameCache(args.cache, stride=args.stride, start=args.start, end=args.end)
+            getFrames = hy.getFrameCacheFrames
+        else:
+            hy.initRealSenseBag(args.bag, stride=args.stride, start=args.start, end=args.end)
+            getFrames = hy.getRealSenseBagFrames
 
-    color, depth = hy.getRealSenseBagFrames()
-    persons = hy.estimate3DPose(color)
-    # hy.viz.drawSkeleton(color, hy.persons2D, upper_body= True)
+        hy.initWindow()
 
-    # persons3D = []
-    # for person in hy.persons3DSeffPose:
-    #     persons3D.append(person)
-    # for person in hy.persons3DRealsense:
-    #     persons3D.append(person)
-    # persons3D = np.array(persons3D)
+        def showFrame(packet):
+            # Cached frames are read-only memory maps
+            color_img = packet.color_img.copy()
+            # hy.viz.drawSkeleton(color_img, packet.persons2D, upper_body= True)
+            hy.plotPersons(color_img, block = False, persons2D=packet.persons2D, persons3D=packet.persons3D)
+            cv2.waitKey(1)
 
-    # hy.viz.show(color, persons3D, block = False)
-    hy.plotPersons(color, block = False)
-    cv2.waitKey(1)
\ No newline at end of file
+        # Grab, detection, lifting and plotting run as pipelined stages.
+        # Recorded frames are never dropped.
+        hy.runPipeline(getFrames, showFrame, policy=BLOCK)
@@ -0,0 +1,146 @@
+import pyrealsense2 as rs
+import os
+from datetime import timedelta
+from multiprocessing import Pool
+
+import numpy as np
+
+class BagReader:
+
+    # Reads a RealSense .bag as fast as it can be decoded (no real-time
+    # pacing), with seeking by time or frame index, stride decimation and
+    # an optional [start, end) time window in seconds
+
+    def __init__(self, path_to_bag, stride = 1, start = None, end = None, align = True, real_time = False):
+
+        if os.path.splitext(path_to_bag)[1] != '.bag':
+            raise Exception(f"{path_to_bag} is not a .bag file.")
+
+        self.path = path_to_bag
+        self.stride = stride
+        # [start, end) window, frames outside it are never returned
+        self.end = end
+        self.skip_until = None
+
+        self.pipeline = rs.pipeline()
+        config = rs.config()
+        rs.config.enable_device_from_file(config, path_to_bag, repeat_playback=False)
+        config.enable_stream(rs.stream.depth)
+        config.enable_stream(rs.stream.color)
+
+        profile = self.pipeline.start(config)
+        self.playback = profile.get_device().as_playback()
+        # Deliver every frame as soon as it is requested instead of at the
+        # recorded rate
+        self.playback.set_real_time(real_time)
+
+        # Depth units to meters
+        self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+        self.fps = profile.get_stream(rs.stream.color).fps()
+        self.duration = self.playback.get_duration().total_seconds()
+
+        self.align = rs.align(rs.stream.color) if align else None
+
+        self.first_timestamp = None
+        self.timestamp = None
+        self.frame_index = -1
+        self.color_frame = None
+        self.depth_frame = None
+
+        if start:
+            self.seekTime(start)
+
+    def _next(self, timeout_ms = 1000):
+
+        # Next frame set, None once the recording is over
+        if self.playback.current_status() == rs.playback_status.stopped:
+            return None
+        ok, frames = self.pipeline.try_wait_for_frames(timeout_ms)
+        if not ok:
+            return None
+
+        # Seconds since the start of the recording
+        if self.first_timestamp is None:
+            self.first_timestamp = frames.get_timestamp() - self.playback.get_position() / 1e6
+        self.timestamp = (frames.get_timestamp() - self.first_timestamp) / 1000
+        self.frame_index = int(round(self.timestamp * self.fps))
+
+        return frames
+
+    def seekTime(self, seconds):
+
+        # Move to the given time (seconds from the start of the recording)
+        self.playback.pause()
+        self.playback.seek(timedelta(seconds=seconds))
+        self.playback.resume()
+        self.skip_until = seconds
+
+    def seekFrame(self, frame_index):
+        self.seekTime(frame_index / self.fps)
+
+    def read(self):
+
+        # Next (color, depth) pair after skipping stride - 1 frame sets, or
+        # None at the end of the recording or of the time window. Skipped
+        # frame sets are neither aligned nor copied.
+        if self.skip_until is not None:
+            # Playback may resume slightly before the seek target, frames
+            # before it belong to the previous window (half-open segments)
+            while True:
+                frames = self._next()
+                if frames is None:
+                    return None
+                if self.timestamp >= self.skip_until:
+                    break
+            self.skip_until = None
+        else:
+            for _ in range(self.stride - 1):
+                if self._next() is None:
+                    return None
+            frames = self._next()
+
+        if frames is None or (self.end is not None and self.timestamp >= self.end):
+            return None
+
+        if self.align is not None:
+            frames = self.align.process(frames)
+
+        self.depth_frame = frames.get_depth_frame()
+        self.color_frame = frames.get_color_frame()
+
+        # Copies, so the playback can reuse its frame buffers
+        color_image = np.array(self.color_frame.get_data())
+        depth_image = np.array(self.depth_frame.get_data())
+
+        return color_image, depth_image
+
+    def close(self):
+        self.pipeline.stop()
+
+def getBagDuration(path_to_bag):
+    # Length of the recording in seconds, without starting a pipeline
+    device = rs.context().load_device(path_to_bag)
+    return device.as_playback().get_duration().total_seconds()
+
+def splitBag(path_to_bag, num_segments, start = None, end = None):
+    # Half-open [start, end) time segments (seconds) covering the [start,
+    # end) window of the recording (the whole recording by default)
+    duration = getBagDuration(path_to_bag)
+    start = start or 0.0
+    end = duration if end is None else min(end, duration)
+    bounds = np.linspace(start, end, num_segments + 1)
+    return [(float(low), float(high)) for low, high in zip(bounds[:-1], bounds[1:])]
+
+def processBagInParallel(path_to_bag, worker, processes = None, num_segments = None, start = None, end = None):
+
+    # Run worker(path_to_bag, start, end) on independent time segments of
+    # the bag (or of its [start, end) window), one process each. worker must
+    # be a module level function and typically opens its own
+    # BagReader(path_to_bag, start=start, end=end), which returns the frames
+    # of [start, end) only, so no frame is processed by two segments.
+    # Returns the worker results in segment order.
+    processes = processes or os.cpu_count()
+    segments = splitBag(path_to_bag, num_segments or processes, start, end)
+
+    with Pool(processes) as pool:
+        return pool.starmap(worker, [(path_to_bag, start, end) for start, end in segments])
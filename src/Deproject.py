@@ -2,6 +2,53 @@ import cv2
 import numpy as np
 import os
 
+def undistortNormalizedPoints(x, y, distortion, inverse = False, iterations = 10):
+
+    # Invert the Brown-Conrady model [k1, k2, p1, p2, k3] by fixed point
+    # iteration, as librealsense does in rs2_deproject_pixel_to_point.
+    # inverse selects its "inverse Brown-Conrady" variant.
+    k1, k2, p1, p2, k3 = distortion[:5]
+    xo, yo = x, y
+    for _ in range(iterations):
+        r2 = x*x + y*y
+        icdist = 1 / (1 + ((k3*r2 + k2)*r2 + k1)*r2)
+        xq, yq = (x/icdist, y/icdist) if inverse else (x, y)
+        delta_x = 2*p1*xq*yq + p2*(r2 + 2*xq*xq)
+        delta_y = 2*p2*xq*yq + p1*(r2 + 2*yq*yq)
+        x = (xo - delta_x)*icdist
+        y = (yo - delta_y)*icdist
+    
+    return x, y
+
+def deprojectKeypointsFromDepth(persons2D, depth_image, cam_mtx, depth_scale = 1.0, distortion = None, inverse_distortion = False):
+
+    # Deproject the (N, K, 2) keypoints of all persons using the depth image.
+    # Returns (N, K, 3) points in depth_image units times depth_scale and an
+    # (N, K) validity mask. Invalid points are set to [-1, -1, -1].
+    persons2D = np.asarray(persons2D, dtype=np.float64)
+    h, w = depth_image.shape[:2]
+
+    u = persons2D[..., 0].astype(int)
+    v = persons2D[..., 1].astype(int)
+    valid = (persons2D[..., 0] != -1) & (u >= 0) & (u < w) & (v >= 0) & (v < h)
+
+    # Read every keypoint depth with a single gather
+    depth = np.zeros(u.shape)
+    depth[valid] = depth_image[v[valid], u[valid]] * depth_scale
+    valid &= depth > 0
+
+    fx, fy = cam_mtx[0][0], cam_mtx[1][1]
+    cx, cy = cam_mtx[0][2], cam_mtx[1][2]
+    x = (u - cx) / fx
+    y = (v - cy) / fy
+    if distortion is not None and np.any(distortion):
+        x, y = undistortNormalizedPoints(x, y, distortion, inverse=inverse_distortion)
+
+    points3D = np.stack((depth*x, depth*y, depth), axis=-1)
+    points3D[~valid] = -1
+
+    return points3D, valid
+
 class Deprojector:
     
     def __init__(self):
@@ -13,6 +60,9 @@ class Deprojector:
                                     [0, 914.7161254882812, 370.6839904785156],
                                     [0, 0, 1]])
         self.distortion = np.array([0.0,0.0,0.0,0.0,0.0])
+
+        # Last rvec/tvec solved for each person, used to seed the next solve
+        self.extrinsics_cache = {}
         
     def loadCameraIntrinsics(self, camera_str):
         
@@ -48,7 +98,7 @@ class Deprojector:
         rotation_matrix, jac = cv2.Rodrigues(rvecs)
         
         # Rotate and Translate points
-        kpts_global = np.dot(rotation_matrix,keypoints3D_local.T) + tvecs.T
+        kpts_global = np.dot(rotation_matrix,keypoints3D_local.T) + tvecs.reshape(3, 1)
         
         # Result will be (3,16) because (3,3)*(16,3).T + (3,1) = (3,16)
         # So, we need to transpose kpts
@@ -66,6 +116,76 @@ class Deprojector:
 
         return kpts_global, posepoints, homogeneous
     
+    def deprojectPoses(self, persons2D, persons3D_local, ids = None, reproject = False, homogeneous = False):
+
+        # Solve the pose of every person of the frame. ids are stable track
+        # ids, used to warm start solvePnP from that person's previous
+        # solution. Without them every solve starts cold: detection order
+        # changes between frames, so the index does not identify a person.
+        # Reprojection and homogeneous matrices are only computed on request.
+        num_persons = len(persons2D)
+        warm_start = ids is not None
+        if ids is None:
+            ids = range(num_persons)
+
+        # Remove nose from keypoints3D
+        persons3D_local = np.delete(np.asarray(persons3D_local, dtype=np.float64), 9, 1)
+        persons2D = np.asarray(persons2D, dtype=np.float64)
+
+        persons3D = np.zeros(persons3D_local.shape)
+        rvecs = np.zeros((num_persons, 3))
+        tvecs = np.zeros((num_persons, 3))
+        cache = {}
+        for idx, person_id in enumerate(ids):
+            guess = self.extrinsics_cache.get(person_id) if warm_start else None
+            rvec, tvec = self._solvePose(persons2D[idx], persons3D_local[idx], guess)
+            cache[person_id] = (rvec, tvec)
+            rvecs[idx] = rvec.ravel()
+            tvecs[idx] = tvec.ravel()
+
+            rotation_matrix, _ = cv2.Rodrigues(rvec)
+            persons3D[idx] = persons3D_local[idx] @ rotation_matrix.T + tvecs[idx]
+
+        # Persons absent from this frame are forgotten
+        self.extrinsics_cache = cache if warm_start else {}
+
+        posepoints = None
+        if reproject and num_persons > 0:
+            # Project all persons to the image plane in one call
+            posepoints, _ = cv2.projectPoints(persons3D.reshape(-1, 3), np.zeros(3), np.zeros(3), self.intrinsics, self.distortion)
+            posepoints = posepoints.reshape(num_persons, -1, 2)
+
+        homogeneous_mtx = None
+        if homogeneous:
+            homogeneous_mtx = np.tile(np.eye(4), (num_persons, 1, 1))
+            for idx in range(num_persons):
+                homogeneous_mtx[idx, :3, :3], _ = cv2.Rodrigues(rvecs[idx])
+            homogeneous_mtx[:, :3, 3] = tvecs
+
+        return persons3D, posepoints, homogeneous_mtx
+
+    def _solvePose(self, keypoints2D, keypoints3D_local, guess):
+
+        # Start from the previous frame solution when there is one,
+        # otherwise from the fixed guess used by deprojectPose
+        if guess is not None:
+            rvec, tvec = guess[0].copy(), guess[1].copy()
+            ret, rvec, tvec = cv2.solvePnP(keypoints3D_local, keypoints2D, self.intrinsics, self.distortion,
+                                           rvec=rvec, tvec=tvec, useExtrinsicGuess=True)
+            # A warm start that ends behind the camera is discarded
+            if ret and tvec[2] > 0:
+                return rvec, tvec
+
+        rvec = np.array([[0], [0], [0]], dtype = np.float64)
+        tvec = np.array([[0], [0], [2000]], dtype = np.float64)
+        _, rvec, tvec = cv2.solvePnP(keypoints3D_local, keypoints2D, self.intrinsics, self.distortion,
+                                     rvec=rvec, tvec=tvec, useExtrinsicGuess=True)
+        
+        return rvec, tvec
+
+    def resetWarmStart(self):
+        self.extrinsics_cache = {}
+    
     def makePersonAxis(self, homogeneous):
 
         axis = np.float32([[300,0,0], [0,300,0], [0,0,-300]]).reshape(-1,3)
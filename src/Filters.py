@@ -0,0 +1,256 @@
+import time
+from abc import ABC, abstractmethod
+import numpy as np
+
+# Temporal filters for the 3D keypoints of tracked persons. The state of
+# every track is kept in (T, K, 3) arrays, one row per track id, so each
+# frame is filtered (or predicted) with a handful of array operations.
+# Missing joints ([-1, -1, -1]) are replaced by their prediction, with a
+# velocity that decays over velocity_decay seconds so the extrapolation
+# stays bounded. A joint unmeasured for more than missing_timeout seconds,
+# or never seen, is -1.
+
+class TemporalFilter(ABC):
+
+    # Subclasses implement the state arrays (_state, _resetState), the
+    # measurement update (_update) and the extrapolation (_extrapolate)
+
+    def __init__(self, num_joints = 16, dims = 3, velocity_decay = 0.2, missing_timeout = 1.0):
+
+        self.num_joints = num_joints
+        self.dims = dims
+        self.velocity_decay = velocity_decay
+        self.missing_timeout = missing_timeout
+        self.reset()
+
+    def reset(self):
+        # track id -> row of the state arrays
+        self.rows = {}
+        self.timestamps = np.zeros(0)
+        self.seen = np.zeros((0, self.num_joints), dtype=bool)
+        # Time of the last measurement of each joint
+        self.measured_at = np.zeros((0, self.num_joints))
+        self._resetState(0)
+
+    @abstractmethod
+    def _resetState(self, size):
+        # Allocates the per track state arrays with size rows
+        pass
+
+    @abstractmethod
+    def _state(self):
+        # Names of the per track state arrays
+        pass
+
+    @abstractmethod
+    def _update(self, rows, persons, measured, seen, dt):
+        # Updates the state rows with the measured joints, returns the
+        # filtered (N, K, 3) persons
+        pass
+
+    @abstractmethod
+    def _extrapolate(self, rows, dt):
+        # (N, K, 3) positions of the state rows dt seconds ahead
+        pass
+
+    def _getRows(self, ids):
+
+        # Rows of the tracks, appending zeroed rows for new ids
+        new_ids = [person_id for person_id in ids if person_id not in self.rows]
+        if new_ids:
+            start = len(self.timestamps)
+            for offset, person_id in enumerate(new_ids):
+                self.rows[person_id] = start + offset
+            self._grow(len(new_ids))
+        return np.array([self.rows[person_id] for person_id in ids], dtype=int)
+
+    def _decay(self, dt):
+        # Velocity factor of a joint left unmeasured for dt seconds
+        return np.exp(-dt / self.velocity_decay)
+
+    def _horizon(self, dt):
+        # Displacement time of the decaying velocity over dt seconds (the
+        # integral of _decay), at most velocity_decay
+        return self.velocity_decay * (1 - self._decay(dt))
+
+    def _grow(self, count):
+        self.timestamps = np.concatenate((self.timestamps, np.zeros(count)))
+        self.seen = np.concatenate((self.seen, np.zeros((count, self.num_joints), dtype=bool)))
+        self.measured_at = np.concatenate((self.measured_at, np.zeros((count, self.num_joints))))
+        for name in self._state():
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros((count,) + array.shape[1:]))))
+
+    def keep(self, ids):
+
+        # Drop the state of every track not in ids (e.g. tracks that ended)
+        ids = [person_id for person_id in ids if person_id in self.rows]
+        rows = np.array([self.rows[person_id] for person_id in ids], dtype=int)
+        self.rows = {person_id: row for row, person_id in enumerate(ids)}
+        self.timestamps = self.timestamps[rows]
+        self.seen = self.seen[rows]
+        self.measured_at = self.measured_at[rows]
+        for name in self._state():
+            setattr(self, name, getattr(self, name)[rows])
+
+    def filter(self, ids, persons, timestamp = None):
+
+        # Filtered (N, K, 3) persons of track ids at timestamp (seconds)
+        persons = np.asarray(persons, dtype=np.float64)
+        if len(persons) == 0:
+            return persons
+        if timestamp is None:
+            timestamp = time.time()
+
+        rows = self._getRows(ids)
+        measured = np.any(persons != -1, axis=-1)
+        # Joints lost for too long start over on their next measurement
+        seen = self.seen[rows] & (timestamp - self.measured_at[rows] <= self.missing_timeout)
+        # Time since each track's last update, (N, 1, 1) to broadcast
+        dt = np.maximum(timestamp - self.timestamps[rows], 1e-6)[:, np.newaxis, np.newaxis]
+
+        filtered = self._update(rows, persons, measured, seen, dt)
+
+        self.seen[rows] = seen | measured
+        self.measured_at[rows] = np.where(measured, timestamp, self.measured_at[rows])
+        self.timestamps[rows] = timestamp
+
+        return np.where(self.seen[rows][..., np.newaxis], filtered, -1)
+
+    def predict(self, ids, timestamp = None):
+
+        # (N, K, 3) poses of track ids extrapolated to timestamp, without
+        # changing the state. Unknown ids, joints never seen and joints lost
+        # for longer than missing_timeout are -1.
+        predicted = np.full((len(ids), self.num_joints, self.dims), -1.0)
+        if timestamp is None:
+            timestamp = time.time()
+
+        known = np.array([person_id in self.rows for person_id in ids], dtype=bool)
+        if not np.any(known):
+            return predicted
+
+        rows = np.array([self.rows[person_id] for person_id in ids if person_id in self.rows], dtype=int)
+        dt = np.maximum(timestamp - self.timestamps[rows], 0)[:, np.newaxis, np.newaxis]
+        valid = self.seen[rows] & (timestamp - self.measured_at[rows] <= self.missing_timeout)
+        predicted[known] = np.where(valid[..., np.newaxis], self._extrapolate(rows, dt), -1)
+
+        return predicted
+
+class OneEuroFilter(TemporalFilter):
+
+    # One-Euro filter (Casiez et al. 2012): a low-pass filter whose cutoff
+    # rises with speed, smoothing jitter at rest and keeping lag low when
+    # moving. Prediction follows the filtered velocity.
+
+    def __init__(self, min_cutoff = 1.0, beta = 0.007, d_cutoff = 1.0, num_joints = 16, dims = 3,
+                 velocity_decay = 0.2, missing_timeout = 1.0):
+
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        super(OneEuroFilter, self).__init__(num_joints, dims, velocity_decay, missing_timeout)
+
+    def _state(self):
+        return ('position', 'velocity')
+
+    def _resetState(self, size):
+        self.position = np.zeros((size, self.num_joints, self.dims))
+        self.velocity = np.zeros((size, self.num_joints, self.dims))
+
+    def _alpha(self, dt, cutoff):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def _update(self, rows, persons, measured, seen, dt):
+
+        position = self.position[rows]
+        velocity = self.velocity[rows]
+
+        # Filtered velocity, then a cutoff adapted to it per coordinate
+        velocity_hat = velocity + self._alpha(dt, self.d_cutoff) * ((persons - position) / dt - velocity)
+        cutoff = self.min_cutoff + self.beta * np.abs(velocity_hat)
+        position_hat = position + self._alpha(dt, cutoff) * (persons - position)
+
+        # First measurement of a joint initializes it, missing joints move
+        # on with their decaying velocity
+        update = (measured & seen)[..., np.newaxis]
+        first = (measured & ~seen)[..., np.newaxis]
+        self.position[rows] = np.where(update, position_hat, np.where(first, persons, position + velocity * self._horizon(dt)))
+        self.velocity[rows] = np.where(update, velocity_hat, np.where(first, 0, velocity * self._decay(dt)))
+
+        return self.position[rows]
+
+    def _extrapolate(self, rows, dt):
+        return self.position[rows] + self.velocity[rows] * self._horizon(dt)
+
+class KalmanFilter(TemporalFilter):
+
+    # Constant velocity Kalman filter, independent per coordinate, with a
+    # white noise acceleration model. process_noise is the acceleration
+    # variance (mm^2/s^4), measurement_noise the keypoint variance (mm^2).
+
+    def __init__(self, process_noise = 1e6, measurement_noise = 400.0, initial_velocity_var = 1e6, num_joints = 16, dims = 3,
+                 velocity_decay = 0.2, missing_timeout = 1.0):
+
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.initial_velocity_var = initial_velocity_var
+        super(KalmanFilter, self).__init__(num_joints, dims, velocity_decay, missing_timeout)
+
+    def _state(self):
+        # Position, velocity and the 2x2 covariance terms of each coordinate
+        return ('position', 'velocity', 'p11', 'p12', 'p22')
+
+    def _resetState(self, size):
+        for name in self._state():
+            setattr(self, name, np.zeros((size, self.num_joints, self.dims)))
+
+    def _predictState(self, rows, dt):
+
+        position = self.position[rows] + self.velocity[rows] * dt
+        velocity = self.velocity[rows]
+
+        q = self.process_noise
+        p11, p12, p22 = self.p11[rows], self.p12[rows], self.p22[rows]
+        p11 = p11 + dt * (2 * p12 + dt * p22) + q * dt**4 / 4
+        p12 = p12 + dt * p22 + q * dt**3 / 2
+        p22 = p22 + q * dt**2
+
+        return position, velocity, p11, p12, p22
+
+    def _update(self, rows, persons, measured, seen, dt):
+
+        position, velocity, p11, p12, p22 = self._predictState(rows, dt)
+
+        # Measurement update, position only
+        innovation = persons - position
+        s = p11 + self.measurement_noise
+        k1 = p11 / s
+        k2 = p12 / s
+        position_hat = position + k1 * innovation
+        velocity_hat = velocity + k2 * innovation
+        p11_hat = (1 - k1) * p11
+        p12_hat = (1 - k1) * p12
+        p22_hat = p22 - k2 * p12
+
+        # First measurement of a joint initializes it, missing joints coast
+        # on their decaying velocity (with a growing uncertainty)
+        update = (measured & seen)[..., np.newaxis]
+        first = (measured & ~seen)[..., np.newaxis]
+        coasted = self.position[rows] + self.velocity[rows] * self._horizon(dt)
+        self.position[rows] = np.where(update, position_hat, np.where(first, persons, coasted))
+        self.velocity[rows] = np.where(update, velocity_hat, np.where(first, 0, velocity * self._decay(dt)))
+        self.p11[rows] = np.where(update, p11_hat, np.where(first, self.measurement_noise, p11))
+        self.p12[rows] = np.where(update, p12_hat, np.where(first, 0, p12))
+        self.p22[rows] = np.where(update, p22_hat, np.where(first, self.initial_velocity_var, p22))
+
+        return self.position[rows]
+
+    def _extrapolate(self, rows, dt):
+        return self.position[rows] + self.velocity[rows] * self._horizon(dt)
+
+FILTERS = {
+    'oneeuro': OneEuroFilter,
+    'kalman': KalmanFilter,
+}
@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+class FlowTracker:
+
+    # Propagates the 2D keypoints of the last detection to the next frames
+    # with sparse pyramidal Lucas-Kanade optical flow, so the 2D detector
+    # only has to run every detect_every frames
+
+    def __init__(self, detect_every = 5, min_confidence = 0.6, fb_threshold = 2.0, win_size = 21, max_level = 3):
+
+        self.detect_every = detect_every
+        # Fraction of a person's joints that must be tracked to trust the flow
+        self.min_confidence = min_confidence
+        # Max forward-backward error (pixels) of a tracked joint
+        self.fb_threshold = fb_threshold
+
+        self.lk_params = dict(winSize=(win_size, win_size), maxLevel=max_level,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+        self.reset()
+
+    def reset(self):
+        self.prev_gray = None
+        self.persons2D = None
+        self.detected = None
+        self.confidence = None
+        self.frames_since_detection = 0
+
+    def needsDetection(self):
+        # With nobody detected there is nothing to track, and new persons
+        # must not wait detect_every frames to be found
+        return (self.persons2D is None or len(self.persons2D) == 0
+                or self.frames_since_detection + 1 >= self.detect_every)
+
+    def setDetections(self, frame, persons2D):
+
+        self.prev_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.persons2D = np.asarray(persons2D, dtype=np.float64)
+        # Joints found by the detector, the reference of the confidence
+        self.detected = np.any(self.persons2D != -1, axis=-1)
+        self.confidence = np.ones(len(self.persons2D))
+        self.frames_since_detection = 0
+
+    def track(self, frame):
+
+        # Returns the (N, K, 2) persons moved to this frame, or None when the
+        # flow lost too many joints of a person and a detection is needed
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.frames_since_detection += 1
+
+        persons2D = self.persons2D
+        # Missing joints keep the [-1, -1] sentinel
+        valid = np.any(persons2D != -1, axis=-1)
+        if not np.any(valid):
+            self.prev_gray = gray
+            return persons2D
+
+        # Forward and backward flow of every joint of every person at once
+        points = persons2D[valid].astype(np.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None, **self.lk_params)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.prev_gray, next_points, None, **self.lk_params)
+        fb_error = np.linalg.norm((points - back_points).reshape(-1, 2), axis=-1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < self.fb_threshold)
+
+        # Lost joints become missing ([-1, -1]) until the next detection
+        moved = np.full(next_points.reshape(-1, 2).shape, -1.0)
+        moved[good] = next_points.reshape(-1, 2)[good]
+        tracked = persons2D.copy()
+        tracked[valid] = moved
+
+        tracked_joints = np.zeros(valid.shape, dtype=bool)
+        tracked_joints[valid] = good
+        # Fraction of the detected joints still tracked, so joints lost on
+        # earlier frames keep counting against the person
+        self.confidence = tracked_joints.sum(axis=1) / np.maximum(self.detected.sum(axis=1), 1)
+
+        self.prev_gray = gray
+        self.persons2D = tracked
+
+        if np.any(self.confidence < self.min_confidence):
+            return None
+
+        return tracked
@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Aligned color/depth frames of a recording extracted once (see
+# tools/extract_bag_frames.py) into .npy files that are memory mapped on
+# read, plus meta.json with the frame count, fps, depth scale and color
+# intrinsics. Reading needs neither librealsense nor decoding.
+
+META_FILE = 'meta.json'
+
+class FrameCacheWriter:
+
+    def __init__(self, path, color_shape, depth_shape, capacity, meta = None):
+
+        # capacity is the expected number of frames, the arrays grow if the
+        # recording turns out longer
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.count = 0
+        self.meta = dict(meta or {})
+
+        self.arrays = {
+            'color': open_memmap(os.path.join(path, 'color.npy'), mode='w+', dtype=np.uint8, shape=(capacity,) + tuple(color_shape)),
+            'depth': open_memmap(os.path.join(path, 'depth.npy'), mode='w+', dtype=np.uint16, shape=(capacity,) + tuple(depth_shape)),
+            'timestamps': open_memmap(os.path.join(path, 'timestamps.npy'), mode='w+', dtype=np.float64, shape=(capacity,)),
+            'frame_index': open_memmap(os.path.join(path, 'frame_index.npy'), mode='w+', dtype=np.int64, shape=(capacity,)),
+        }
+
+    def _grow(self):
+        for name in list(self.arrays):
+            file_path = os.path.join(self.path, name + '.npy')
+            tmp_path = os.path.join(self.path, name + '.tmp.npy')
+            # Drop every reference to the old memory map before replacing
+            # its file, so it is unmapped (an open mapping blocks the replace
+            # on Windows)
+            array = self.arrays.pop(name)
+            array.flush()
+            grown = open_memmap(tmp_path, mode='w+', dtype=array.dtype, shape=(max(1, 2 * len(array)),) + array.shape[1:])
+            grown[:len(array)] = array
+            grown.flush()
+            del array, grown
+            os.replace(tmp_path, file_path)
+            self.arrays[name] = open_memmap(file_path, mode='r+')
+
+    def append(self, color_image, depth_image, timestamp, frame_index):
+
+        if self.count == len(self.arrays['color']):
+            self._grow()
+
+        self.arrays['color'][self.count] = color_image
+        self.arrays['depth'][self.count] = depth_image
+        self.arrays['timestamps'][self.count] = timestamp
+        self.arrays['frame_index'][self.count] = frame_index
+        self.count += 1
+
+    def close(self):
+
+        for array in self.arrays.values():
+            array.flush()
+        self.meta['count'] = self.count
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+class FrameCache:
+
+    # Frame source over an extracted recording. read() hands out read-only
+    # views of the memory maps (no copy), so callers drawing on the images
+    # must copy them first. start/end restrict reading to a time window in
+    # seconds, as in BagReader.
+
+    def __init__(self, path, stride = 1, start = None, end = None):
+
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+        count = self.meta['count']
+        # Memory maps beyond count hold unused preallocated frames
+        self.color = np.load(os.path.join(path, 'color.npy'), mmap_mode='r')[:count]
+        self.depth = np.load(os.path.join(path, 'depth.npy'), mmap_mode='r')[:count]
+        self.timestamps = np.load(os.path.join(path, 'timestamps.npy'), mmap_mode='r')[:count]
+        self.frame_indices = np.load(os.path.join(path, 'frame_index.npy'), mmap_mode='r')[:count]
+
+        self.fps = self.meta['fps']
+        self.depth_scale = self.meta['depth_scale']
+        self.cam_mtx = np.array(self.meta['cam_mtx'])
+        self.distortion = None if self.meta['distortion'] is None else np.array(self.meta['distortion'])
+        self.inverse_distortion = self.meta['inverse_distortion']
+
+        # Time and bag frame number of the last frame read
+        self.timestamp = None
+        self.frame_index = -1
+
+        self.stride = stride
+        self.end = count if end is None else int(np.searchsorted(self.timestamps, end))
+        self.position = 0
+        if start:
+            self.seekTime(start)
+
+    def __len__(self):
+        return len(self.color)
+
+    def __getitem__(self, idx):
+        return self.color[idx], self.depth[idx]
+
+    def seekFrame(self, position):
+        # Position in the cache (not the bag frame number, see frame_indices)
+        self.position = position
+
+    def seekTime(self, seconds):
+        self.position = int(np.searchsorted(self.timestamps, seconds))
+
+    def read(self):
+
+        # Next (color, depth) pair, None at the end
+        if self.position >= self.end:
+            return None
+
+        frames = self[self.position]
+        self.timestamp = float(self.timestamps[self.position])
+        self.frame_index = int(self.frame_indices[self.position])
+        self.position += self.stride
+
+        return frames
@@ -1,39 +1,74 @@
 import numpy as np
 
+# Source flags returned per joint by the batch fusion
+FUSED_NONE = 0
+FUSED_STEREO = 1
+FUSED_MLP = 2
+
 class Fusion:
 
     def mergeResults(self, kpts_stereo, kpts_mlp, thresh = 500):
 
         assert(kpts_stereo.shape == kpts_mlp.shape)
         
-        # Filter points that are far than 2 meters of the centroid
-        kpts_stereo = self.filterStereoKpts(kpts_stereo, 2000)
+        # Single person case of the batch fusion
+        kpts_merged, _ = self.mergeResultsBatch(kpts_stereo[np.newaxis], kpts_mlp[np.newaxis], thresh=thresh)
+
+        return kpts_merged[0]
+    
+    def mergeResultsBatch(self, kpts_stereo, kpts_mlp, valid_stereo = None, valid_mlp = None, thresh = 500, global_thresh = 2000):
+
+        # kpts_stereo and kpts_mlp are (N, K, 3) arrays, valid masks are (N, K).
+        # Missing masks are derived from the [-1, -1, -1] sentinel.
+        kpts_stereo = np.asarray(kpts_stereo, dtype=np.float64)
+        kpts_mlp = np.asarray(kpts_mlp, dtype=np.float64)
+        assert(kpts_stereo.shape == kpts_mlp.shape)
+
+        if valid_stereo is None:
+            valid_stereo = np.any(kpts_stereo != -1, axis=-1)
+        if valid_mlp is None:
+            valid_mlp = np.any(kpts_mlp != -1, axis=-1)
+        valid_stereo = np.asarray(valid_stereo, dtype=bool)
+        valid_mlp = np.asarray(valid_mlp, dtype=bool)
 
-        # Translate mlp kpts to stereo centroid
-        kpts_mlp = self.translateMLP(kpts_mlp, kpts_stereo)
+        # Filter points that are far than global_thresh of the centroid
+        stereo_centroids = self.centroids(kpts_stereo, valid_stereo)
+        valid_stereo = valid_stereo & (self.distance(kpts_stereo, stereo_centroids[:, np.newaxis]) < global_thresh)
+
+        # Translate mlp kpts to the filtered stereo centroid.
+        # Persons without any stereo joint keep their mlp position.
+        stereo_centroids = self.centroids(kpts_stereo, valid_stereo)
+        mlp_centroids = self.centroids(kpts_mlp, valid_mlp)
+        t = np.nan_to_num(stereo_centroids - mlp_centroids)
+        kpts_mlp = kpts_mlp + t[:, np.newaxis]
 
         # Compare MLP and Stereo results 
-        # if kpts mlp - stereo < comp_thresh: kpts_stereo is used
+        # if kpts mlp - stereo < thresh: kpts_stereo is used
         # else kpts mlp is used
-        # also if kpts_stereo is [-1, -1, -1], mlp is used
-        num_kpts = len(kpts_stereo)
-        kpts_merged = np.ones((num_kpts, 3))*(-1)
-
+        # also if kpts_stereo is missing, mlp is used
         dists = self.distance(kpts_stereo, kpts_mlp)
-        for idx, (_, dist) in enumerate(zip(kpts_merged, dists)):
-            if dist < thresh:
-                kpts_merged[idx] = kpts_stereo[idx]
-            else:
-                kpts_merged[idx] = kpts_mlp[idx]
+        use_stereo = valid_stereo & (~valid_mlp | (dists < thresh))
+        use_mlp = valid_mlp & ~use_stereo
 
-        return kpts_merged
+        kpts_merged = np.where(use_stereo[..., np.newaxis], kpts_stereo,
+                               np.where(use_mlp[..., np.newaxis], kpts_mlp, -1.0))
+        flags = np.where(use_stereo, FUSED_STEREO, np.where(use_mlp, FUSED_MLP, FUSED_NONE))
+
+        return kpts_merged, flags
+    
+    def centroids(self, kpts, valid):
+        # Mean of the valid joints of each person, NaN if it has none
+        count = np.sum(valid, axis=-1)[..., np.newaxis]
+        total = np.sum(np.where(valid[..., np.newaxis], kpts, 0.0), axis=-2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
     
     def distance(self, pt1, pt2):
         # ex = abs(pts1[:,0] - pts2[:,0])
         # ey = abs(pts1[:,1] - pts2[:,1])
         # ez = abs(pts1[:,2] - pts2[:,2])
         # dist = np.sqrt(ex**2 + ey**2 + ez**2)
-        dist = np.sqrt(np.sum(np.power(pt1-pt2,2), axis=1))
+        dist = np.sqrt(np.sum(np.power(pt1-pt2,2), axis=-1))
         return dist
 
     def filterStereoKpts(self, kpts_stereo, global_thresh):
@@ -42,15 +77,8 @@ class Fusion:
         centroid = np.mean(kpts_stereo, axis=0, where=(kpts_stereo!=[-1,-1,-1]))
         
         # kpts global filtered
-        kpts_stereo_cpy = kpts_stereo.copy()
-
         dists = self.distance(kpts_stereo, centroid)
-        for idx, kpt in enumerate(kpts_stereo):
-            dist = dists[idx]
-            if dist < global_thresh:
-                kpts_stereo_cpy[idx] = kpts_stereo[idx]
-            else:
-                kpts_stereo_cpy[idx] = [-1, -1, -1]
+        kpts_stereo_cpy = np.where((dists < global_thresh)[:, np.newaxis], kpts_stereo, -1.0)
 
         ### Local filter
         #TODO  
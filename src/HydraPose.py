@@ -1,16 +1,11 @@
+import sys
+import importlib
 import numpy as np
-import cv2
-from enum import Enum
-
-from .OpenPose import * 
-from .KeypointRCNN import *
-from .SeffPose import *
-from .RealSense import *
-from .SkeletonsBridge import *
-from .Deproject import *
-from .Fusion import *
-from .Visualizer import *
-from .RosHandler import *
+
+from .SkeletonsBridge import SkeletonsBridge
+from .Pipeline import Pipeline, DROP_OLDEST, BLOCK
+from .ModelRegistry import MODELS
+from .Person import Person, Frame
 
 OPENPOSE = 0
 KEYPOINTMASKRCNN = 1
@@ -18,9 +13,54 @@ SEFFPOSE = 2
 REALSENSE = 3
 FULL = 4
 
+# Backends are plugins imported on first use, so a run only imports (and
+# only needs installed) the libraries its configuration actually uses
+BACKENDS = {
+    'OpenPose': ('.OpenPose', 'OpenPose'),
+    'KeypointRCNN': ('.KeypointRCNN', 'KeypointRCNN'),
+    'SeffPose': ('.SeffPose', 'SeffPose'),
+    'RealSense': ('.RealSense', 'RealSense'),
+    'Deprojector': ('.Deproject', 'Deprojector'),
+    'Fusion': ('.Fusion', 'Fusion'),
+    'FlowTracker': ('.FlowTracker', 'FlowTracker'),
+    'PersonTracker': ('.Tracking', 'PersonTracker'),
+    'oneeuro': ('.Filters', 'OneEuroFilter'),
+    'kalman': ('.Filters', 'KalmanFilter'),
+    'Visualizer': ('.Visualizer', 'Visualizer'),
+    'RosHandler': ('.RosHandler', 'RosHandler'),
+}
+
+# 2D backend for each pose2D mode
+POSE2D_BACKENDS = {
+    OPENPOSE: 'OpenPose',
+    KEYPOINTMASKRCNN: 'KeypointRCNN',
+}
+
+def registerBackend(name, module, attr):
+    # module may be relative to this package ('.OpenPose') or absolute
+    BACKENDS[name] = (module, attr)
+
+def loadBackend(name):
+    module, attr = BACKENDS[name]
+    return getattr(importlib.import_module(module, __package__), attr)
+
+def addModelArguments(parser):
+    # Command line options of the models, shared by the scripts
+    parser.add_argument('--runtime', default='torch', choices=['torch', 'onnxruntime'],
+                        help="KeypointRCNN runtime")
+    parser.add_argument('--profile', default=None, choices=['default', 'cpu'],
+                        help="KeypointRCNN model profile")
+    parser.add_argument('--optimized-seffpose', action='store_true',
+                        help="int8 SeffPose model from tools/optimize_seffpose.py")
+
+def modelOptions(args):
+    # (pose2D_options, pose3D_options) for HydraPose from addModelArguments
+    return {'runtime': args.runtime, 'profile': args.profile}, {'optimized': args.optimized_seffpose}
+
 class HydraPose:
 
-    def __init__(self, pose2D = KEYPOINTMASKRCNN, pose3D = FULL, ros = False):
+    def __init__(self, pose2D = KEYPOINTMASKRCNN, pose3D = FULL, ros = False, headless = False, detect_every = 1, track = False, smoothing = None,
+                 pose2D_options = None, pose3D_options = None):
 
         # Config atribs
         self.mode2D = pose2D
@@ -34,45 +74,72 @@ class HydraPose:
         # Standard atribs
         self.persons2D = None
         self.persons3DHybrid  = None
+        self.fusion_flags = None
+        self.valid3DRealsense = None
+        self.ids = None
 
         
         # Init architeture
-        # Init pose 2D
-        if self.mode2D == OPENPOSE:
-            self.pose2d = OpenPose()
-        if self.mode2D == KEYPOINTMASKRCNN:
-            self.pose2d = KeypointRCNN()
+        # Init pose 2D (pose2D may also name a registered backend)
+        self.pose2d = loadBackend(POSE2D_BACKENDS.get(self.mode2D, self.mode2D))()
+
+        # Model options of the 2D detector (runtime, profile, threads...)
+        self.pose2d.defineModel(**(pose2D_options or {}))
+
+        # Run the 2D detector every detect_every frames and track the
+        # keypoints with optical flow in between
+        self.flow = None
+        if detect_every > 1:
+            self.flow = loadBackend('FlowTracker')(detect_every)
 
-        self.pose2d.defineModel()
+        # Persistent person ids across frames
+        self.tracker = None
+        if track or smoothing is not None:
+            self.tracker = loadBackend('PersonTracker')()
+
+        # Temporal filter of the 3D output ('oneeuro' or 'kalman'), keyed by track id
+        self.filter = None
+        if smoothing is not None:
+            self.filter = loadBackend(smoothing)()
 
         # Init bridge
         self.bridge = SkeletonsBridge()
 
         # Init deprojector
         if self.mode3D == FULL or self.mode3D == SEFFPOSE:
-            self.deproj = Deprojector()
+            self.deproj = loadBackend('Deprojector')()
 
         # Init pose 3D
-        if self.mode3D == FULL:
-            self.seff = SeffPose()
-            self.seff.defineModel()
+        if self.mode3D == FULL or self.mode3D == SEFFPOSE:
+            self.seff = loadBackend('SeffPose')()
+            # SeffPose options (net, optimized)
+            self.seff.defineModel(**(pose3D_options or {}))
 
-            self.rlsns = RealSense()
-            self.fus = Fusion()
-            
-        elif self.mode3D == SEFFPOSE:
-            self.seff = SeffPose()
-            self.seff.defineModel()
+        if self.mode3D == FULL or self.mode3D == REALSENSE:
+            self.rlsns = loadBackend('RealSense')()
 
-        elif self.mode3D == REALSENSE:
-            self.rlsns = RealSense()
+        if self.mode3D == FULL:
+            self.fus = loadBackend('Fusion')()
 
-        # Init visualizer
-        self.viz = Visualizer()
+        # Visualizer (and matplotlib) is only loaded when plotting
+        self.headless = headless
+        self._viz = None
 
         # Init ROS
         if self.mode_ros == True:
-            self.ros = RosHandler()
+            self.ros = loadBackend('RosHandler')()
+
+    def warmUp(self):
+        # Run one dummy inference on every model loaded in this process
+        MODELS.warmUp()
+
+    @property
+    def viz(self):
+        if self._viz is None:
+            if self.headless:
+                raise Exception("Visualizer is not available in headless mode.")
+            self._viz = loadBackend('Visualizer')()
+        return self._viz
 
     def initRealSense(self):
         self.rlsns.initRealSense()
@@ -83,12 +150,39 @@ class HydraPose:
         
         return self.color_img, self.depth_img
 
-    def initRealSenseBag(self, filepath):
-        self.rlsns.initializeStreamFromBag(filepath)
+    def initRealSenseBag(self, filepath, stride = 1, start = None, end = None, real_time = False):
+        self.rlsns.initializeStreamFromBag(filepath, stride=stride, start=start, end=end, real_time=real_time)
+
+    def seekRealSenseBag(self, seconds = None, frame_index = None):
+        self.rlsns.seekBag(seconds, frame_index)
 
     def getRealSenseBagFrames(self):
 
-        self.color_img, self.depth_img = self.rlsns.getBagFrames()
+        # None at the end of the recording, which also ends runPipeline
+        frames = self.rlsns.getBagFrames(colorize=False)
+        if frames is None:
+            return None
+
+        self.color_img, self.depth_img = frames
+
+        return self.color_img, self.depth_img
+
+    def initFrameCache(self, path, stride = 1, start = None, end = None):
+        # Replaying a cache needs no camera, so the reader is also created
+        # in the modes that do not use the RealSense
+        if getattr(self, 'rlsns', None) is None:
+            self.rlsns = loadBackend('RealSense')()
+        self.rlsns.initializeStreamFromCache(path, stride=stride, start=start, end=end)
+
+    def getFrameCacheFrames(self):
+
+        # Zero-copy frames of a cache written by tools/extract_bag_frames.py.
+        # They are read-only, copy them before drawing. None at the end.
+        frames = self.rlsns.getCacheFrames()
+        if frames is None:
+            return None
+
+        self.color_img, self.depth_img = frames
 
         return self.color_img, self.depth_img
     
@@ -99,8 +193,9 @@ class HydraPose:
 
         self.deproj.intrinsics = intrinsics
         self.deproj.distortion = distortion
+        self.deproj.resetWarmStart()
     
-    def estimate3DPose(self, color_img):
+    def estimate3DPose(self, color_img, depth_img = None, timestamp = None):
 
         if(color_img is None):
             print("Image empty.")
@@ -109,87 +204,168 @@ class HydraPose:
         h = color_img.shape[0]
         w = color_img.shape[1]
 
-        self.persons2D = self.pose2d.estimate2DPose(color_img)
+        self.persons2D = self.estimate2DPose(color_img)
 
         # Return if persons is empty
         if len(self.persons2D) == 0:
+            self.ids = self.trackPersons(self.persons2D)
+            self._forgetEndedTracks()
             return []
         
+        self.persons3DHybrid = self.estimate3DFrom2D(self.persons2D, w, h, depth_img, timestamp)
+        
+        return self.persons3DHybrid
+
+    def estimate2DPose(self, color_img):
+
+        if self.flow is None:
+            return self.pose2d.estimate2DPose(color_img)
+
+        # Between detections the keypoints follow the optical flow, unless
+        # tracking gets unreliable
+        if not self.flow.needsDetection():
+            persons2D = self.flow.track(color_img)
+            if persons2D is not None:
+                return persons2D
+
+        persons2D = self.pose2d.estimate2DPose(color_img)
+        self.flow.setDetections(color_img, persons2D)
+
+        return persons2D
+
+    def estimate3DFrom2D(self, persons2D, w, h, depth_img = None, timestamp = None):
+
+        # depth_img defaults to the last frame grabbed from the RealSense.
+        # With tracking, self.ids holds the track id of each person.
+        # timestamp (seconds, default now) is the frame time for smoothing.
         if self.mode3D == FULL:
-            self.persons3DRealsense = self.estimate3DPoseRealsense(self.persons2D)
-            self.persons3DSeffPose = self.estimate3DPoseSeffpose(self.persons2D, w, h)
-            self.persons3DHybrid = self.fuseResultsSeffPoseRealsense(self.persons3DRealsense, self.persons3DSeffPose)
+            self.persons3DRealsense = self.estimate3DPoseRealsense(persons2D, depth_img)
+            self.ids = self.trackPersons(persons2D, self.persons3DRealsense)
+            self.persons3DSeffPose = self.estimate3DPoseSeffpose(persons2D, w, h, self.ids)
+            persons3D = self.fuseResultsSeffPoseRealsense(self.persons3DRealsense, self.persons3DSeffPose)
 
         elif self.mode3D == SEFFPOSE:
-            persons3DSeffPose = self.estimate3DPoseSeffpose(self.persons2D, w, h)
-            self.persons3DHybrid = persons3DSeffPose 
+            self.ids = self.trackPersons(persons2D)
+            persons3D = self.estimate3DPoseSeffpose(persons2D, w, h, self.ids)
 
         elif self.mode3D == REALSENSE:
-            persons3DRealsense = self.estimate3DPoseRealsense(self.persons2D)
-            self.persons3DHybrid = persons3DRealsense
+            persons3D = self.estimate3DPoseRealsense(persons2D, depth_img)
+            self.ids = self.trackPersons(persons2D, persons3D)
+
+        if self.filter is not None:
+            self.persons3DRaw = persons3D
+            persons3D = self.filter.filter(self.ids, persons3D, timestamp)
+            self._forgetEndedTracks()
+
+        if self.tracker is not None:
+            self.tracker.setPoses3D(self.ids, persons3D)
         
-        return self.persons3DHybrid
+        return persons3D
+
+    def predict3DPose(self, timestamp = None):
+
+        # Smoothed 3D poses of the current tracks extrapolated to timestamp
+        # (default now), for frames that were skipped or are still being
+        # processed. Returns the track ids and their (N, 16, 3) poses.
+        if self.filter is None:
+            raise Exception("Prediction needs a smoothing filter.")
+
+        ids = [track.id for track in self.tracker.tracks if track.id in self.filter.rows]
+        return ids, self.filter.predict(ids, timestamp)
+
+    def trackPersons(self, persons2D, persons3D = None):
+        # Track ids of the persons, None without tracking
+        if self.tracker is None:
+            return None
+        return self.tracker.update(persons2D, persons3D)
+
+    def _forgetEndedTracks(self):
+        if self.filter is not None:
+            self.filter.keep([track.id for track in self.tracker.tracks])
 
-    def estimate3DPoseRealsense(self, persons2D):
+    def getPersons(self):
+        # Person objects of the last frame, in detection order
+        if self.tracker is None or self.ids is None:
+            return []
+        return self.tracker.getPersons(self.ids)
+
+    def estimate3DPoseRealsense(self, persons2D, depth_img = None):
         
-        persons3D = []
-        for person2D in persons2D:
-            person3D = self.rlsns.deprojectPose3D(person2D)
-            persons3D.append(person3D)
-        # Meters to milimiter
-        persons3D = np.array(persons3D)*1000
+        persons3D, valid = self.rlsns.deprojectPoses3D(persons2D, depth_img)
+        self.valid3DRealsense = valid
+        # Meters to milimiter, keeping the [-1, -1, -1] sentinel
+        persons3D = np.where(valid[..., np.newaxis], persons3D*1000, -1)
         
         return persons3D
 
-    def estimate3DPoseSeffpose(self, persons2D, w, h):
+    def estimate3DPoseSeffpose(self, persons2D, w, h, ids = None):
+        
+        # Lift every person of the frame in one batch
+        persons2D_norm = self.seff.normalizePoses2D(persons2D, w, h)
+        persons3D_local = self.seff.estimatePoses3Dfrom2DKeypoints(persons2D_norm)
         
-        persons3D = []
-        for person2D in persons2D:
-            person2D_norm = self.seff.normalizePose2D(person2D, w, h)
-            person3D = self.seff.estimatePose3Dfrom2DKeypoints(person2D_norm)
-            person3D_deproj,_,_ = self.deproj.deprojectPose(person2D, person3D)
-            persons3D.append(person3D_deproj)
+        # Place them in the camera frame, warm started from the last frame
+        # per track id when tracking, cold started otherwise
+        persons3D, _, _ = self.deproj.deprojectPoses(persons2D, persons3D_local, ids)
         
-        return np.array(persons3D)
+        return persons3D
     
     def fuseResultsSeffPoseRealsense(self, persons3DRealsense, persons3DSeffPose):
         
         if(persons3DSeffPose.shape != persons3DRealsense.shape):
             print("Results shape dont match!")
         
-        personsHybrid3D = []
-        for i in range(len(persons3DSeffPose)):
-            person3D = self.fus.mergeResults(persons3DRealsense[i], persons3DSeffPose[i])
-            personsHybrid3D.append(person3D)
+        # Fuse all persons at once, keeping the per-joint source flags
+        # (missing stereo joints carry the [-1, -1, -1] sentinel)
+        personsHybrid3D, self.fusion_flags = self.fus.mergeResultsBatch(persons3DRealsense, persons3DSeffPose)
         
-        return np.array(personsHybrid3D)
+        return personsHybrid3D
+
+    def runPipeline(self, source, sink, queue_size = 2, policy = DROP_OLDEST, workers2D = 1, ordered = True):
+
+        # Run capture, 2D detection, 3D lifting/fusion and output as
+        # separate stages connected by bounded queues. source() returns a
+        # color image or a (color, depth) tuple, None to stop; sink(packet)
+        # runs on the calling thread and may return False to stop.
+        # Only the 2D stage can have several workers (workers2D), which needs
+        # a thread-safe detector (KeypointRCNN) and frames that may reach the
+        # 3D stage out of order: no optical flow (detect_every = 1), tracking
+        # or smoothing. The 3D stage keeps per-frame state (solvePnP warm
+        # starts, fusion flags, tracks, filters) and always has one worker.
+        if workers2D > 1 and (self.flow is not None or self.tracker is not None):
+            raise Exception("Optical flow, tracking and smoothing need frames in order, use a single 2D worker.")
+        stages = [('2D', self._detect2DStage, workers2D),
+                  ('3D', self._lift3DStage, 1)]
+        self.pipeline = Pipeline(source, stages, queue_size=queue_size, policy=policy, ordered=ordered)
+        self.pipeline.run(sink)
+
+        return self.pipeline
+
+    def _detect2DStage(self, packet):
+        packet.persons2D = self.estimate2DPose(packet.color_img)
+
+    def _lift3DStage(self, packet):
+        if len(packet.persons2D) == 0:
+            packet.persons3D = []
+            # Tracks still age on frames without persons
+            packet.ids = self.trackPersons(packet.persons2D)
+            self._forgetEndedTracks()
+            return
+        h, w = packet.color_img.shape[:2]
+        packet.persons3D = self.estimate3DFrom2D(packet.persons2D, w, h, packet.depth_img, packet.timestamps['capture'])
+        packet.ids = self.ids
 
     def initWindow(self):
         self.viz.initWindows()
 
-    def plotPersons(self, color_img, mode='Human36M', block = True):
-
-        self.viz.drawSkeleton(color_img, self.persons2D, mode=mode, upper_body=True)
-        self.viz.show(color_img, self.persons3DHybrid, block=block, mode=mode)
-        # self.viz.show(image,self.depth_img,self.persons3DHybrid, block = False)
-
-class Person:
-
-    def __init__(self, kpts2D = None, kpts3D = None):
-        self.kpts2D = kpts2D
-        self.kpts3D = kpts3D
-        self.frame = Frame.WORLD
-        self.id = None
-        self.name = None
-    
-    def transformFrame(self, frameTo):
-        pass 
-
-    def toSkeletonType(self):
-        pass
+    def plotPersons(self, color_img, mode='Human36M', block = True, persons2D = None, persons3D = None):
 
-class Frame(Enum):
+        # Plots the last estimation unless persons are given
+        if persons2D is None:
+            persons2D = self.persons2D
+        if persons3D is None:
+            persons3D = self.persons3DHybrid
 
-    WORLD = 0
-    ROBOT = 1
-    CAM = 2
\ No newline at end of file
+        self.viz.drawSkeleton(color_img, persons2D, mode=mode, upper_body=True)
+        self.viz.show(color_img, persons3D, block=block, mode=mode)
+        # self.viz.show(image,self.depth_img,self.persons3DHybrid, block = False)
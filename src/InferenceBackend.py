@@ -0,0 +1,121 @@
+from abc import ABC, abstractmethod
+import numpy as np
+
+# Inference runtimes a detector can run its network on. Pre and post
+# processing stay in the detectors: a backend only maps the network inputs
+# to its outputs, so the fastest runtime can be picked per host.
+
+# ONNX Runtime graph optimization levels by name
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+class InferenceBackend(ABC):
+
+    name = None
+
+    @abstractmethod
+    def run(self, inputs):
+        # inputs is a list of network inputs, returns the list of outputs
+        pass
+
+    def warmUp(self, inputs):
+        self.run(inputs)
+
+class OpenCVBackend(InferenceBackend):
+
+    name = 'opencv'
+
+    def __init__(self, net, device = 'cpu', threads = None):
+
+        import cv2
+
+        self.net = net
+
+        if device == "cpu":
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        elif device == "gpu":
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+
+        # OpenCV uses one thread pool for the whole process
+        if threads is not None:
+            cv2.setNumThreads(threads)
+
+    @classmethod
+    def fromCaffe(cls, protoFile, weightsFile, device = 'cpu', threads = None):
+        import cv2
+        return cls(cv2.dnn.readNetFromCaffe(protoFile, weightsFile), device, threads)
+
+    def run(self, inputs):
+        self.net.setInput(inputs[0])
+        return [self.net.forward()]
+
+class TorchBackend(InferenceBackend):
+
+    name = 'torch'
+
+    def __init__(self, model, device = 'cpu', intra_op_threads = None, inter_op_threads = None):
+
+        import torch
+
+        self.torch = torch
+        self.model = model
+        self.device = device
+
+        # Torch thread pools are process-wide, and the inter-op pool can only
+        # be sized before its first use
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError:
+                print("Torch inter-op threads already set, keeping them.")
+
+    def run(self, inputs):
+        # Outputs are returned as the model gives them (tensors, dicts...)
+        with self.torch.inference_mode():
+            return self.model(*inputs)
+
+class OnnxRuntimeBackend(InferenceBackend):
+
+    name = 'onnxruntime'
+
+    def __init__(self, model_path, intra_op_threads = 0, inter_op_threads = 0, graph_optimization = 'all',
+                 cpu_mem_arena = True, mem_pattern = True, parallel = False, providers = ('CPUExecutionProvider',)):
+
+        # Optional dependency, only needed when this backend is selected
+        import onnxruntime as ort
+
+        # 0 threads lets ONNX Runtime use its defaults
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[graph_optimization])
+        options.enable_cpu_mem_arena = cpu_mem_arena
+        options.enable_mem_pattern = mem_pattern
+        # Parallel execution runs independent branches on the inter-op pool
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if parallel else ort.ExecutionMode.ORT_SEQUENTIAL
+
+        self.session = ort.InferenceSession(model_path, options, providers=list(providers))
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.output_names = [node.name for node in self.session.get_outputs()]
+
+    def run(self, inputs):
+        feed = {name: np.ascontiguousarray(value) for name, value in zip(self.input_names, inputs)}
+        return self.session.run(self.output_names, feed)
+
+RUNTIMES = {
+    OpenCVBackend.name: OpenCVBackend,
+    TorchBackend.name: TorchBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+}
+
+def optionsKey(options):
+    # Hashable form of backend options, to tell shared models apart
+    return tuple(sorted(options.items()))
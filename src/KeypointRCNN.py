@@ -1,17 +1,31 @@
 # 3D Pose Estimation with Keypoint-RCNN and RealSense stereo camera
 
-import cv2
-import matplotlib
 import torch
 import torchvision
 import numpy as np
-import argparse
 import time
 
-from PIL import Image
-from torchvision.transforms import transforms as transforms
-
 from .SkeletonsBridge import *
+from .ModelRegistry import MODELS
+from .InferenceBackend import TorchBackend, OnnxRuntimeBackend, optionsKey
+
+# Graph written by tools/export_onnx.py and its outputs, in order
+ONNX_FILE = "models/keypointrcnn/keypointrcnn_resnet50_fpn.onnx"
+ONNX_OUTPUTS = ['boxes', 'labels', 'scores', 'keypoints', 'keypoints_scores']
+
+# Model settings of the torch runtime. min_size/max_size is the inference
+# scale (torchvision rescales the keypoints back to the frame), fold_bgr
+# makes the model take BGR in [0, 255] so frames need no conversion.
+DEFAULT_PROFILE = {'min_size': 800, 'max_size': 1333, 'channels_last': False, 'fold_bgr': False}
+
+# Fast CPU profile: native scale for 640x480 RealSense frames, NHWC tensors
+# and threads set explicitly (inter-op parallelism does not help here).
+# intra_op_threads None is the torch thread count when the model is defined,
+# so caps set by the caller (e.g. one share of the cores per worker) hold.
+CPU_PROFILE = {'min_size': 480, 'max_size': 640, 'channels_last': True, 'fold_bgr': True,
+               'intra_op_threads': None, 'inter_op_threads': 1}
+
+PROFILES = {'default': DEFAULT_PROFILE, 'cpu': CPU_PROFILE}
 
 class KeypointRCNN:
 
@@ -24,6 +38,9 @@ class KeypointRCNN:
         (5, 7), (7, 9), (5, 11), (11, 13), (13, 15), (6, 12),
         (12, 14), (14, 16), (5, 6)]
 
+        # Minimum detection score for a person to be kept
+        self.min_score = 0.95
+
         self.use_cuda = torch.cuda.is_available()
         if self.use_cuda:
             print("Starting device with CUDA...")
@@ -31,61 +48,130 @@ class KeypointRCNN:
             print("Starting device with CPU...")
         
 
-    def defineModel(self):
-
-        # initialize the model
-        self.model = torchvision.models.detection.keypointrcnn_resnet50_fpn(pretrained=True,
-                                                                    num_keypoints=17)
+    def defineModel(self, runtime = 'torch', profile = None, **runtime_options):
+
+        # runtime is 'torch' (eager torchvision) or 'onnxruntime' (CPU only,
+        # graph from tools/export_onnx.py); runtime_options go to the backend.
+        # profile (a dict such as CPU_PROFILE or its name in PROFILES) sets
+        # the torch model settings and threads.
+        self.runtime = runtime
+        if runtime == 'onnxruntime':
+            self.use_cuda = False
+        if isinstance(profile, str):
+            profile = PROFILES[profile]
+        options = dict(profile or {}, **runtime_options)
+        if 'intra_op_threads' in options and options['intra_op_threads'] is None:
+            options['intra_op_threads'] = torch.get_num_threads()
+        self.profile = {key: options.pop(key, value) for key, value in DEFAULT_PROFILE.items()}
+        # Only the torch model folds the channel order
+        self.fold_bgr = runtime == 'torch' and self.profile['fold_bgr']
         # set the computation device
         self.device = torch.device('cuda' if self.use_cuda else 'cpu')
+        checkpoint = ONNX_FILE if runtime == 'onnxruntime' else 'keypointrcnn_resnet50_fpn'
+        # the model is built once per process and shared
+        self.model = MODELS.get('KeypointRCNN/' + runtime, (checkpoint, optionsKey(self.profile), optionsKey(options)), self.device,
+                                lambda: self._loadModel(runtime, options), warmup=self._warmUpModel)
+
+    def _loadModel(self, runtime, runtime_options):
+
+        if runtime == 'onnxruntime':
+            return OnnxRuntimeBackend(ONNX_FILE, **runtime_options)
+        if runtime != 'torch':
+            raise Exception(f"Runtime {runtime} is not available for KeypointRCNN.")
+
+        # initialize the model
+        model = torchvision.models.detection.keypointrcnn_resnet50_fpn(pretrained=True,
+                                                                    num_keypoints=17,
+                                                                    min_size=self.profile['min_size'],
+                                                                    max_size=self.profile['max_size'])
+        if self.profile['fold_bgr']:
+            self._foldBGRInput(model)
         # load the modle on to the computation device and set to eval mode
-        self.model.to(self.device).eval()
-        # initialize transform obj
-        self.transform = transforms.Compose([transforms.ToTensor()])
+        model.to(self.device).eval()
+        if self.profile['channels_last']:
+            model.to(memory_format=torch.channels_last)
+        # Shared instances are read-only
+        model.requires_grad_(False)
+
+        return TorchBackend(model, self.device, **runtime_options)
+
+    def _foldBGRInput(self, model):
+
+        # Take BGR images in [0, 255]: reverse the input channels of the first
+        # convolution and of the normalization, and scale it by 255
+        conv1 = model.backbone.body.conv1
+        conv1.weight.data = conv1.weight.data.flip(1).contiguous()
+        model.transform.image_mean = [255 * mean for mean in reversed(model.transform.image_mean)]
+        model.transform.image_std = [255 * std for std in reversed(model.transform.image_std)]
+
+    def _warmUpModel(self, model):
+        self._runModel(model, torch.zeros((1, 3, 480, 640), device=self.device))
+
+    def _runModel(self, model, images):
+
+        if model.name == 'torch':
+            return model.run([images])
+
+        # The exported graph takes one (3, H, W) image. Its outputs are handed
+        # back as tensors so both runtimes share the post-processing.
+        return [dict(zip(ONNX_OUTPUTS, map(torch.from_numpy, model.run([image.numpy()]))))
+                for image in images]
     
     def estimate2DPose(self, frame):
 
-        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return self.estimate2DPoseBatch([frame])[0]
 
-        # transform the image
-        image = self.transform(rgb)
+    def estimate2DPoseBatch(self, frames, batch_size = 8):
 
-        # add a batch dimension
-        image = image.unsqueeze(0).to(self.device)
+        # Detect persons on many BGR frames, batch_size frames per forward.
+        # Returns one (N, 16, 2) HM36M person array per frame.
+        persons_per_frame = []
+        for start in range(0, len(frames), batch_size):
+            images = self._framesToTensor(frames[start:start + batch_size])
 
-        t0 = time.time()
-        with torch.no_grad():
-            self.outputs = self.model(image)
-        self.inference_time = time.time() - t0
-        
-        persons, scores = self._getKeypointsAndPersonScores()
-        
-        persons = self._filterPersonsbyScore(persons, scores, min_thresh = 0.95)
+            t0 = time.time()
+            outputs = self._runModel(self.model, images)
+            self.inference_time = time.time() - t0
+            self.outputs = outputs
+
+            persons_per_frame.extend(self._getPersonsFromOutputs(outputs))
+
+        return persons_per_frame
+
+    def _framesToTensor(self, frames):
+
+        # BGR uint8 (H, W, 3) frames to float (3, H, W) tensors: RGB in [0, 1],
+        # or with the BGR input folded into the model, the frames as they are.
+        # Frames of the same size are stacked into one (B, 3, H, W) tensor.
+        if all(frame.shape == frames[0].shape for frame in frames):
+            batch = np.ascontiguousarray(frames[0])[np.newaxis] if len(frames) == 1 else np.stack(frames)
+            images = torch.from_numpy(batch).to(self.device).permute(0, 3, 1, 2)
+            return self._toFloat(images, 1)
+
+        return [self._toFloat(torch.from_numpy(np.ascontiguousarray(frame)).to(self.device).permute(2, 0, 1), 0)
+                for frame in frames]
+
+    def _toFloat(self, images, channel_dim):
+        # The permuted uint8 view is already channels_last, so the float
+        # conversion is the only copy when the BGR input is folded
+        if self.fold_bgr:
+            return images.float()
+        return images.flip(channel_dim).float().div_(255)
 
+    def _getPersonsFromOutputs(self, outputs):
+
+        # Score filtering and visibility column removal stay on tensors
+        keypoints = []
+        for output in outputs:
+            keep = output['scores'] > self.min_score
+            keypoints.append(output['keypoints'][keep][:, :, :2])
+        counts = [len(kpts) for kpts in keypoints]
+
+        # Single transfer and skeleton conversion for the whole batch
+        persons = torch.cat(keypoints).cpu().numpy()
         persons = self.bridge.transformPersonsFromTo(persons, "COCO", 'HM36M')
 
-        return np.array(persons)
-    
-    def _filterPersonsbyScore(self, persons, scores, min_thresh = 0.4):
-        persons_filtered = []
-        for i in range(len(scores)):
-            if scores[i] > min_thresh:
-                persons_filtered.append(persons[i])
-        
-        return persons_filtered
-        
-    def _getKeypointsAndPersonScores(self):
-        
-        # Get keypoints
-        self.persons = np.asanyarray(self.outputs[0]['keypoints'])
-        
-        # Get scores
-        self.person_scores = np.asanyarray(self.outputs[0]['scores'])
-        
-        # Remove visibility collum
-        self.persons = self.persons[:,:,:2]
-        
-        return self.persons, self.person_scores
+        return np.split(persons, np.cumsum(counts)[:-1])
 
     # # TODO: Recieve keypoints instead outputs
     # def drawSkeleton(self, frame, persons):
@@ -0,0 +1,113 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Cost of matching an estimate that has no joint present
+UNMATCHABLE = 1e9
+
+def jointErrors(persons_est, persons_ann):
+
+    # (N_est, N_ann, J) euclidean error of every joint of every estimate
+    # against every annotation, NaN where the estimated joint is missing
+    # (the [-1, -1, -1] sentinel)
+    persons_est = np.asarray(persons_est, dtype=np.float64).reshape(-1, *np.shape(persons_ann)[1:])
+    persons_ann = np.asarray(persons_ann, dtype=np.float64)
+
+    errors = np.linalg.norm(persons_est[:, np.newaxis] - persons_ann[np.newaxis], axis=-1)
+    missing = np.all(persons_est == -1, axis=-1)
+    errors[np.broadcast_to(missing[:, np.newaxis], errors.shape)] = np.nan
+
+    return errors
+
+def matchPersons(persons_est, persons_ann):
+
+    # One-to-one assignment of estimates to annotations minimizing the mean
+    # joint error. Returns the matched estimate and annotation indices and
+    # their (k, J) joint errors; extra estimates or annotations are left out.
+    errors = jointErrors(persons_est, persons_ann)
+    if errors.shape[0] == 0 or errors.shape[1] == 0:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros((0, errors.shape[2]))
+
+    present = ~np.isnan(errors)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = np.where(present, errors, 0).sum(axis=-1) / present.sum(axis=-1)
+    cost = np.where(np.isfinite(cost), cost, UNMATCHABLE)
+
+    est_idx, ann_idx = linear_sum_assignment(cost)
+
+    return est_idx, ann_idx, errors[est_idx, ann_idx]
+
+class RunningMetrics:
+
+    # MPJPE, per-joint error and PCK accumulated as running sums over the
+    # matched persons of every sample. Missing joints do not count in the
+    # errors and count as wrong in the PCK.
+
+    def __init__(self, num_joints, pck_thresholds = (150,)):
+
+        self.pck_thresholds = np.asarray(pck_thresholds, dtype=np.float64)
+
+        self.persons = 0
+        self.joints = 0
+        self.error_sum = 0.0
+        self.joint_error_sum = np.zeros(num_joints)
+        self.joint_count = np.zeros(num_joints, dtype=np.int64)
+        self.joint_correct = np.zeros((len(self.pck_thresholds), num_joints), dtype=np.int64)
+        # Estimates / annotations left without a match
+        self.unmatched_est = 0
+        self.unmatched_ann = 0
+
+    def update(self, errors, num_est = None, num_ann = None):
+
+        # errors are the (k, J) joint errors of the matched persons, num_est
+        # and num_ann the number of persons on each side before matching
+        errors = np.asarray(errors, dtype=np.float64)
+        present = ~np.isnan(errors)
+
+        self.persons += len(errors)
+        self.joints += errors.size
+        self.error_sum += errors[present].sum()
+        self.joint_error_sum += np.where(present, errors, 0).sum(axis=0)
+        self.joint_count += present.sum(axis=0)
+        with np.errstate(invalid='ignore'):
+            self.joint_correct += (errors[np.newaxis] <= self.pck_thresholds[:, np.newaxis, np.newaxis]).sum(axis=1)
+
+        if num_est is not None:
+            self.unmatched_est += num_est - len(errors)
+        if num_ann is not None:
+            self.unmatched_ann += num_ann - len(errors)
+
+    def merge(self, other):
+
+        # Adds the sums of another RunningMetrics (e.g. of another shard)
+        self.persons += other.persons
+        self.joints += other.joints
+        self.error_sum += other.error_sum
+        self.joint_error_sum += other.joint_error_sum
+        self.joint_count += other.joint_count
+        self.joint_correct += other.joint_correct
+        self.unmatched_est += other.unmatched_est
+        self.unmatched_ann += other.unmatched_ann
+
+    @property
+    def mpjpe(self):
+        return self.error_sum / max(self.joint_count.sum(), 1)
+
+    @property
+    def jointError(self):
+        # NaN for joints never estimated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.joint_count > 0, self.joint_error_sum / self.joint_count, np.nan)
+
+    @property
+    def pck(self):
+        # {threshold: fraction of matched joints within it}
+        return {float(t): correct.sum() / max(self.joints, 1) for t, correct in zip(self.pck_thresholds, self.joint_correct)}
+
+    def report(self):
+
+        lines = [f"MPJPE: {self.mpjpe:.1f} mm over {self.persons} persons "
+                 f"({self.unmatched_est} unmatched estimates, {self.unmatched_ann} unmatched annotations)"]
+        lines += [f"PCK@{t:g}mm: {100 * value:.1f}%" for t, value in self.pck.items()]
+        lines += ["Mean Error Per Joint:", str(self.jointError)]
+
+        return "\n".join(lines)
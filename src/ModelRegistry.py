@@ -0,0 +1,53 @@
+import threading
+
+class ModelRegistry:
+
+    def __init__(self):
+
+        # (backend, checkpoint, device) -> [model, warmup function, warmed up]
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def get(self, backend, checkpoint, device, loader, warmup = None):
+
+        # Returns the shared instance, calling loader() only the first time.
+        # Instances are shared read-only: callers must not train or modify them.
+        key = (backend, checkpoint, str(device))
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = [loader(), warmup, False]
+            return self.entries[key][0]
+
+    def _select(self, backend, checkpoint, device):
+        return [key for key in self.entries
+                if (backend is None or key[0] == backend)
+                and (checkpoint is None or key[1] == checkpoint)
+                and (device is None or key[2] == str(device))]
+
+    def warmUp(self, backend = None, checkpoint = None, device = None):
+
+        # Run the warm-up hook of the matching models that were not warmed up yet
+        with self.lock:
+            for key in self._select(backend, checkpoint, device):
+                entry = self.entries[key]
+                if entry[1] is not None and not entry[2]:
+                    entry[1](entry[0])
+                    entry[2] = True
+
+    def evict(self, backend = None, checkpoint = None, device = None):
+
+        # Drop the matching models (all of them by default). Instances already
+        # handed out stay alive until their users release them.
+        with self.lock:
+            keys = self._select(backend, checkpoint, device)
+            for key in keys:
+                del self.entries[key]
+
+        return len(keys)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+# Process-wide registry shared by every HydraPose instance
+MODELS = ModelRegistry()
@@ -3,6 +3,8 @@ import time
 import numpy as np
 
 from .SkeletonsBridge import *
+from .ModelRegistry import MODELS
+from .InferenceBackend import OpenCVBackend, OnnxRuntimeBackend, optionsKey
 
 class OpenPose:
     
@@ -32,92 +34,140 @@ class OpenPose:
                 [0,255,0], [255,200,100], [255,0,255], [0,255,0], [255,200,100], [255,0,255],
                 [0,0,255], [255,0,0], [200,200,0], [255,0,0], [200,200,0], [0,0,0]]
         
-    def _getKeypoints(self, probMap, threshold=0.05):
+    # Find the peaks of all part maps at once, at network resolution.
+    # probMaps is (nParts, H, W); returns, for each part, a list of
+    # (x, y, prob) with x, y in frame pixels.
+    def _getKeypoints(self, probMaps, threshold=0.1, refine=True):
 
-        mapSmooth = cv2.GaussianBlur(probMap,(3,3),0,0)
+        nParts, mapHeight, mapWidth = probMaps.shape
 
-        mapMask = np.uint8(mapSmooth>threshold)
-        keypoints = []
+        # Channels last so blur and max-filter handle every part in one call
+        mapSmooth = cv2.GaussianBlur(np.ascontiguousarray(probMaps.transpose(1, 2, 0)), (3,3), 0, 0)
+        mapSmooth = mapSmooth.reshape(mapHeight, mapWidth, nParts)
 
-        #find the blobs
-        contours, _ = cv2.findContours(mapMask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # Non-maximum suppression: a peak is the maximum of its 3x3 neighbourhood
+        mapMax = cv2.dilate(mapSmooth, np.ones((3,3), np.uint8)).reshape(mapHeight, mapWidth, nParts)
+        peaks = ((mapSmooth == mapMax) & (mapSmooth > threshold)).transpose(2, 0, 1)
 
-        #for each blob find the maxima
-        for cnt in contours:
-            blobMask = np.zeros(mapMask.shape)
-            blobMask = cv2.fillConvexPoly(blobMask, cnt, 1)
-            maskedProbMap = mapSmooth * blobMask
-            _, maxVal, _, maxLoc = cv2.minMaxLoc(maskedProbMap)
-            keypoints.append(maxLoc + (probMap[maxLoc[1], maxLoc[0]],))
+        parts, ys, xs = np.nonzero(peaks)
+        parts, ys, xs = self._firstOfPlateaus(peaks, parts, ys, xs)
+        scores = probMaps[parts, ys, xs]
+        px = xs.astype(np.float64)
+        py = ys.astype(np.float64)
+
+        # Sub-pixel position from a parabola through the peak and its neighbours
+        if refine:
+            center = mapSmooth[ys, xs, parts]
+            inner = (xs > 0) & (xs < mapWidth - 1)
+            left = mapSmooth[ys, np.maximum(xs - 1, 0), parts]
+            right = mapSmooth[ys, np.minimum(xs + 1, mapWidth - 1), parts]
+            px += np.where(inner, self._parabolaOffset(left, center, right), 0)
+            inner = (ys > 0) & (ys < mapHeight - 1)
+            up = mapSmooth[np.maximum(ys - 1, 0), xs, parts]
+            down = mapSmooth[np.minimum(ys + 1, mapHeight - 1), xs, parts]
+            py += np.where(inner, self._parabolaOffset(up, center, down), 0)
+
+        # Network to frame pixels
+        px = (px + 0.5) * self.frameWidth / mapWidth - 0.5
+        py = (py + 0.5) * self.frameHeight / mapHeight - 0.5
+
+        keypoints = [[] for _ in range(nParts)]
+        for part, x, y, score in zip(parts, px, py, scores):
+            keypoints[part].append((x, y, score))
 
         return keypoints
+
+    # Every cell of a flat maximum passes the max-filter test, so keep only
+    # the first cell (raster order) of each 8-connected group of peaks.
+    # Adjacent peaks always have the same value, so a group is one plateau.
+    def _firstOfPlateaus(self, peaks, parts, ys, xs):
+        nParts, mapHeight, mapWidth = peaks.shape
+        if len(parts) == 0:
+            return parts, ys, xs
+        # Part maps side by side, one empty column apart, labelled in one call
+        tiled = np.zeros((mapHeight, nParts, mapWidth + 1), np.uint8)
+        tiled[:, :, :mapWidth] = peaks.transpose(1, 0, 2)
+        _, labels = cv2.connectedComponents(tiled.reshape(mapHeight, -1), connectivity=8)
+        labels = labels.reshape(mapHeight, nParts, mapWidth + 1)
+        _, first = np.unique(labels[ys, parts, xs], return_index=True)
+        first.sort()
+        return parts[first], ys[first], xs[first]
+
+    def _parabolaOffset(self, before, center, after):
+        curvature = before - 2 * center + after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+        return np.clip(offset, -0.5, 0.5)
     
+    # Sample a network output map at frame coordinates (..., 2) as if the map
+    # had been resized to frame size with bilinear interpolation
+    def _sampleMap(self, netMap, points):
+        mapHeight, mapWidth = netMap.shape
+        sx = (points[..., 0] + 0.5) * mapWidth / self.frameWidth - 0.5
+        sy = (points[..., 1] + 0.5) * mapHeight / self.frameHeight - 0.5
+        sx = np.clip(sx, 0, mapWidth - 1)
+        sy = np.clip(sy, 0, mapHeight - 1)
+        x0 = np.floor(sx).astype(int)
+        y0 = np.floor(sy).astype(int)
+        x1 = np.minimum(x0 + 1, mapWidth - 1)
+        y1 = np.minimum(y0 + 1, mapHeight - 1)
+        fx = sx - x0
+        fy = sy - y0
+        top = netMap[y0, x0] * (1 - fx) + netMap[y0, x1] * fx
+        bottom = netMap[y1, x0] * (1 - fx) + netMap[y1, x1] * fx
+        return top * (1 - fy) + bottom * fy
+
+    # Score every candA -> candB connection of one limb at once and keep,
+    # for each candA, its best valid candB as rows [idA, idB, score]
+    def _scoreLimb(self, pafA, pafB, candA, candB, n_interp_samples = 10, paf_score_th = 0.1, conf_th = 0.7):
+        
+        A = candA[:, np.newaxis, :2]
+        B = candB[np.newaxis, :, :2]
+
+        # Find d_ij for all (i, j) pairs
+        d_ij = B - A
+        norm = np.linalg.norm(d_ij, axis=-1)
+        nonzero = norm > 0
+        d_ij = d_ij / np.where(nonzero, norm, 1)[..., np.newaxis]
+
+        # Find p(u) for all pairs: (nA, nB, n_interp_samples, 2)
+        t = np.linspace(0, 1, n_interp_samples)[:, np.newaxis]
+        interp_coord = np.rint(A[:, :, np.newaxis] + t * (B - A)[:, :, np.newaxis])
+
+        # Find L(p(u)) with one gather per PAF channel, then E
+        paf_interp = np.stack((self._sampleMap(pafA, interp_coord), self._sampleMap(pafB, interp_coord)), axis=-1)
+        paf_scores = np.sum(paf_interp * d_ij[:, :, np.newaxis], axis=-1)
+        avg_paf_score = np.mean(paf_scores, axis=-1)
+
+        # If the fraction of interpolated vectors aligned with PAF is higher then threshold -> Valid Pair
+        valid = nonzero & (np.count_nonzero(paf_scores > paf_score_th, axis=-1) / n_interp_samples > conf_th)
+        scores = np.where(valid, avg_paf_score, -np.inf)
+
+        # Best candB for each candA
+        max_j = np.argmax(scores, axis=1)
+        maxScore = scores[np.arange(len(candA)), max_j]
+        found = maxScore > -1
+
+        return np.column_stack((candA[found, 3], candB[max_j[found], 3], maxScore[found]))
+
     # Find valid connections between the different joints of a all persons present
     def _getValidPairs(self, output, detected_keypoints):
         valid_pairs = []
         invalid_pairs = []
-        n_interp_samples = 10
-        paf_score_th = 0.1
-        conf_th = 0.7
         # loop for every POSE_PAIR
         for k in range(len(self.mapIdx)):
-            # A->B constitute a limb
+            # A->B constitute a limb, PAFs stay at network resolution
             pafA = output[0, self.mapIdx[k][0], :, :]
             pafB = output[0, self.mapIdx[k][1], :, :]
-            pafA = cv2.resize(pafA, (self.frameWidth, self.frameHeight))
-            pafB = cv2.resize(pafB, (self.frameWidth, self.frameHeight))
 
             # Find the keypoints for the first and second limb
-            candA = detected_keypoints[self.POSE_PAIRS[k][0]]
-            candB = detected_keypoints[self.POSE_PAIRS[k][1]]
-            nA = len(candA)
-            nB = len(candB)
+            candA = np.array(detected_keypoints[self.POSE_PAIRS[k][0]], dtype=np.float64)
+            candB = np.array(detected_keypoints[self.POSE_PAIRS[k][1]], dtype=np.float64)
 
             # If keypoints for the joint-pair is detected
-            # check every joint in candA with every joint in candB
-            # Calculate the distance vector between the two joints
-            # Find the PAF values at a set of interpolated points between the joints
-            # Use the above formula to compute a score to mark the connection valid
-
-            if( nA != 0 and nB != 0):
-                valid_pair = np.zeros((0,3))
-                for i in range(nA):
-                    max_j=-1
-                    maxScore = -1
-                    found = 0
-                    for j in range(nB):
-                        # Find d_ij
-                        d_ij = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = np.linalg.norm(d_ij)
-                        if norm:
-                            d_ij = d_ij / norm
-                        else:
-                            continue
-                        # Find p(u)
-                        interp_coord = list(zip(np.linspace(candA[i][0], candB[j][0], num=n_interp_samples),
-                                                np.linspace(candA[i][1], candB[j][1], num=n_interp_samples)))
-                        # Find L(p(u))
-                        paf_interp = []
-                        for k in range(len(interp_coord)):
-                            paf_interp.append([pafA[int(round(interp_coord[k][1])), int(round(interp_coord[k][0]))],
-                                            pafB[int(round(interp_coord[k][1])), int(round(interp_coord[k][0]))] ])
-                        # Find E
-                        paf_scores = np.dot(paf_interp, d_ij)
-                        avg_paf_score = sum(paf_scores)/len(paf_scores)
-
-                        # Check if the connection is valid
-                        # If the fraction of interpolated vectors aligned with PAF is higher then threshold -> Valid Pair
-                        if ( len(np.where(paf_scores > paf_score_th)[0]) / n_interp_samples ) > conf_th :
-                            if avg_paf_score > maxScore:
-                                max_j = j
-                                maxScore = avg_paf_score
-                                found = 1
-                    # Append the connection to the list
-                    if found:
-                        valid_pair = np.append(valid_pair, [[candA[i][3], candB[max_j][3], maxScore]], axis=0)
-
-                # Append the detected connections to the global list
-                valid_pairs.append(valid_pair)
+            # score every joint in candA against every joint in candB
+            if( len(candA) != 0 and len(candB) != 0):
+                valid_pairs.append(self._scoreLimb(pafA, pafB, candA, candB))
             else: # If no keypoints are detected
                 invalid_pairs.append(k)
                 valid_pairs.append([])
@@ -127,36 +177,43 @@ class OpenPose:
     # For each detected valid pair, it assigns the joint(s) to a person
     def _getPersonwiseKeypoints(self, valid_pairs, invalid_pairs, keypoints_list):
         # the last number in each row is the overall score
-        personwiseKeypoints = -1 * np.ones((0, 19))
+        # Every new person comes from a valid pair, so that bounds the rows
+        max_persons = sum(len(valid_pairs[k]) for k in range(17) if k not in invalid_pairs)
+        personwiseKeypoints = -1 * np.ones((max_persons, 19))
+        n_persons = 0
+
+        # (part, keypoint id) -> rows holding that keypoint for that part.
+        # The owner of a keypoint is the lowest of its rows.
+        owners = {}
+
+        def assign(row, part, keypoint_id):
+            previous = personwiseKeypoints[row, part]
+            if previous != -1:
+                owners[(part, previous)].discard(row)
+            personwiseKeypoints[row, part] = keypoint_id
+            owners.setdefault((part, keypoint_id), set()).add(row)
 
         for k in range(len(self.mapIdx)):
             if k not in invalid_pairs:
-                partAs = valid_pairs[k][:,0]
-                partBs = valid_pairs[k][:,1]
-                indexA, indexB = np.array(self.POSE_PAIRS[k])
-
-                for i in range(len(valid_pairs[k])):
-                    found = 0
-                    person_idx = -1
-                    for j in range(len(personwiseKeypoints)):
-                        if personwiseKeypoints[j][indexA] == partAs[i]:
-                            person_idx = j
-                            found = 1
-                            break
-
-                    if found:
-                        personwiseKeypoints[person_idx][indexB] = partBs[i]
-                        personwiseKeypoints[person_idx][-1] += keypoints_list[partBs[i].astype(int), 2] + valid_pairs[k][i][2]
+                indexA, indexB = self.POSE_PAIRS[k]
+
+                for partA, partB, score in valid_pairs[k]:
+                    rows = owners.get((indexA, partA))
+
+                    if rows:
+                        person_idx = min(rows)
+                        assign(person_idx, indexB, partB)
+                        personwiseKeypoints[person_idx, -1] += keypoints_list[int(partB), 2] + score
 
                     # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(19)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
+                    elif k < 17:
+                        assign(n_persons, indexA, partA)
+                        assign(n_persons, indexB, partB)
                         # add the keypoint_scores for the two keypoints and the paf_score
-                        row[-1] = sum(keypoints_list[valid_pairs[k][i,:2].astype(int), 2]) + valid_pairs[k][i][2]
-                        personwiseKeypoints = np.vstack([personwiseKeypoints, row])
-        return personwiseKeypoints
+                        personwiseKeypoints[n_persons, -1] = keypoints_list[int(partA), 2] + keypoints_list[int(partB), 2] + score
+                        n_persons += 1
+
+        return personwiseKeypoints[:n_persons]
 
     #TODO: draw by persons
     def drawSkeleton(self, frame):
@@ -177,48 +234,63 @@ class OpenPose:
         
         for i in range(self.nPoints):
             for j in range(len(detected_keypoints[i])):
-                cv2.circle(frame, detected_keypoints[i][j][0:2], 5, self.colors[i], -1, cv2.LINE_AA)
+                cv2.circle(frame, (int(round(detected_keypoints[i][j][0])), int(round(detected_keypoints[i][j][1]))), 5, self.colors[i], -1, cv2.LINE_AA)
         
         return frame
 
     def _getPersons(self, keypoints_list, personwiseKeypoints):
         
-        persons = np.zeros((len(personwiseKeypoints),18,2))
-        for i in range(18):
-            for n in range(len(personwiseKeypoints)):
-                if (personwiseKeypoints[n][i] != -1):
-                    persons[n][i]=keypoints_list[int(personwiseKeypoints[n][i]),[0,1]]
-                else:
-                    persons[n][i]=-1
+        # Gather the (x, y) of every part of every person at once
+        ids = personwiseKeypoints[:, :18].astype(int)
+        persons = keypoints_list[ids, :2] if len(keypoints_list) else np.zeros(ids.shape + (2,))
+        persons[ids == -1] = -1
         return persons
 
-    def defineModel(self):
-        
+    def defineModel(self, runtime = 'opencv', **runtime_options):
+
+        # runtime is 'opencv' (Caffe model) or 'onnxruntime' (model exported
+        # with tools/export_onnx.py); runtime_options go to the backend
         mode = "COCO"
         self.inWidth = 363
         self.inHeight = 363
         
-        if mode is "COCO":
+        if mode == "COCO":
             protoFile = "models/openpose/coco/pose_deploy_linevec.prototxt"
             weightsFile = "models/openpose/coco/pose_iter_440000.caffemodel"
+            onnxFile = "models/openpose/coco/pose_coco.onnx"
             self.nPoints = 18
             POSE_PAIRS = [ [1,0],[1,2],[1,5],[2,3],[3,4],[5,6],[6,7],[1,8],[8,9],[9,10],[1,11],[11,12],[12,13],[0,14],[0,15],[14,16],[15,17]]
 
-        elif mode is "MPII" :
+        elif mode == "MPII" :
             protoFile = "models/openpose/mpii/pose_deploy_linevec_faster_4_stages.prototxt"
             weightsFile = "models/openpose/mpii/pose_iter_160000.caffemodel"
+            onnxFile = "models/openpose/mpii/pose_mpii.onnx"
             self.nPoints = 16
             POSE_PAIRS = [[0,1], [1,2], [2,3], [3,4], [1,5], [5,6], [6,7], [1,14], [14,8], [8,9], [9,10], [14,11], [11,12], [12,13] ]
 
-        self.net = cv2.dnn.readNetFromCaffe(protoFile, weightsFile)
-        
-        if self.device == "cpu":
-            self.net.setPreferableBackend(cv2.dnn.DNN_TARGET_CPU)
-            print("Using CPU device")
-        elif self.device == "gpu":
-            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-            print("Using GPU device")
+        self.runtime = runtime
+        checkpoint = onnxFile if runtime == 'onnxruntime' else weightsFile
+
+        # The network is read once per process and shared
+        self.net = MODELS.get('OpenPose/' + runtime, (checkpoint, optionsKey(runtime_options)), self.device,
+                              lambda: self._loadModel(runtime, protoFile, weightsFile, onnxFile, runtime_options),
+                              warmup=self._warmUpModel)
+
+    def _loadModel(self, runtime, protoFile, weightsFile, onnxFile, runtime_options):
+
+        if runtime == 'opencv':
+            net = OpenCVBackend.fromCaffe(protoFile, weightsFile, self.device, **runtime_options)
+        elif runtime == 'onnxruntime':
+            net = OnnxRuntimeBackend(onnxFile, **runtime_options)
+        else:
+            raise Exception(f"Runtime {runtime} is not available for OpenPose.")
+
+        print(f"Using {runtime} on {self.device} device")
+
+        return net
+
+    def _warmUpModel(self, net):
+        net.warmUp([np.zeros((1, 3, self.inHeight, self.inWidth), dtype=np.float32)])
 
     def estimate2DPose(self, frame):
 
@@ -228,27 +300,21 @@ class OpenPose:
         t = time.time()
         
         inpBlob = cv2.dnn.blobFromImage(frame, 1.0 / 255, (self.inWidth, self.inHeight), (0, 0, 0), swapRB=False, crop=False)
-        self.net.setInput(inpBlob)
-        output = self.net.forward()
+        output = self.net.run([inpBlob])[0]
         
         self.inference_time = time.time() - t
         
+        threshold = 0.1
+        keypoints_per_part = self._getKeypoints(output[0, :self.nPoints], threshold)
+
+        # One [x, y, prob] row per keypoint, the keypoint id being its row
+        self.keypoints_list = np.array([keypoint for keypoints in keypoints_per_part for keypoint in keypoints],
+                                       dtype=np.float64).reshape(-1, 3)
         self.detected_keypoints = []
-        self.keypoints_list = np.zeros((0,3))
         keypoint_id = 0
-        threshold = 0.1
-        for part in range(self.nPoints):
-            probMap = output[0,part,:,:]
-            probMap = cv2.resize(probMap, (frame.shape[1], frame.shape[0]))
-            keypoints = self._getKeypoints(probMap, threshold)
-            # print("Keypoints - {} : {}".format(keypointsMapping[part], keypoints))
-            keypoints_with_id = []
-            for i in range(len(keypoints)):
-                keypoints_with_id.append(keypoints[i] + (keypoint_id,))
-                self.keypoints_list = np.vstack([self.keypoints_list, keypoints[i]])
-                keypoint_id += 1
-
-            self.detected_keypoints.append(keypoints_with_id)
+        for keypoints in keypoints_per_part:
+            self.detected_keypoints.append([keypoint + (keypoint_id + i,) for i, keypoint in enumerate(keypoints)])
+            keypoint_id += len(keypoints)
         
         frameClone = frame.copy()
         valid_pairs, invalid_pairs = self._getValidPairs(output,self.detected_keypoints)
@@ -256,6 +322,6 @@ class OpenPose:
 
         persons = self._getPersons(self.keypoints_list, self.personwiseKeypoints)
         
-        persons = self.bridge.transformFromTo(persons, "OpenPoseCOCO", 'HM36M')
+        persons = self.bridge.transformPersonsFromTo(persons, "OpenPoseCOCO", 'HM36M')
 
         return np.array(persons)
\ No newline at end of file
@@ -0,0 +1,27 @@
+from enum import Enum
+
+class Person:
+
+    def __init__(self, kpts2D = None, kpts3D = None):
+        self.kpts2D = kpts2D
+        self.kpts3D = kpts3D
+        self.frame = Frame.WORLD
+        self.id = None
+        self.name = None
+
+        # Tracking state: frames since the person was last matched and
+        # number of frames it was matched in
+        self.missed = 0
+        self.hits = 0
+
+    def transformFrame(self, frameTo):
+        pass
+
+    def toSkeletonType(self):
+        pass
+
+class Frame(Enum):
+
+    WORLD = 0
+    ROBOT = 1
+    CAM = 2
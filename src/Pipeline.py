@@ -0,0 +1,224 @@
+import heapq
+import threading
+import time
+from collections import deque
+
+# Queue policies when a stage is faster than the next one
+DROP_OLDEST = 0
+BLOCK = 1
+
+# Marks the end of the stream inside the queues
+END = object()
+
+class FramePacket:
+
+    def __init__(self, seq, color_img, depth_img = None):
+        self.seq = seq
+        self.color_img = color_img
+        self.depth_img = depth_img
+        self.persons2D = None
+        self.persons3D = None
+        # Track ids of the persons when HydraPose tracks them
+        self.ids = None
+        # Time at which the packet left each stage
+        self.timestamps = {'capture': time.time()}
+
+class StageQueue:
+
+    def __init__(self, maxsize, policy = DROP_OLDEST, on_drop = None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_drop = on_drop
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, item, force = False):
+        with self.cond:
+            while not force and not self.closed and len(self.items) >= self.maxsize:
+                if self.policy == DROP_OLDEST and self.items[0] is not END:
+                    dropped = self.items.popleft()
+                    if self.on_drop is not None:
+                        self.on_drop(dropped)
+                else:
+                    self.cond.wait(0.1)
+            if self.closed:
+                return
+            self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                if self.closed:
+                    return END
+                self.cond.wait(0.1)
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Pipeline:
+
+    def __init__(self, source, stages, queue_size = 2, policy = DROP_OLDEST, ordered = True):
+
+        # source() returns a color image, a (color, depth) tuple or None
+        # when the stream is over. stages is a list of (name, function,
+        # workers), each function filling the FramePacket it receives.
+        self.source = source
+        self.stages = stages
+        self.ordered = ordered
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+        self.dropped = set()
+
+        # One queue in front of each stage plus one for the output
+        self.queues = [StageQueue(queue_size, policy, self._onDrop) for _ in range(len(stages) + 1)]
+        self.workers_done = [0] * len(stages)
+
+        # Per stage processed frames and busy time
+        self.stats = {name: [0, 0.0] for name, _, _ in stages}
+        self.stats['capture'] = [0, 0.0]
+        self.stats['output'] = [0, 0.0]
+
+    def _onDrop(self, packet):
+        with self.lock:
+            self.dropped.add(packet.seq)
+
+    def _acquire(self):
+        seq = 0
+        try:
+            while not self.stopped.is_set():
+                t0 = time.time()
+                frame = self.source()
+                if frame is None:
+                    break
+                if isinstance(frame, tuple):
+                    packet = FramePacket(seq, frame[0], frame[1])
+                else:
+                    packet = FramePacket(seq, frame)
+                self._count('capture', t0)
+                self.queues[0].put(packet)
+                seq += 1
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0][2]):
+                self.queues[0].put(END, force=True)
+
+    def _work(self, stage_idx):
+        name, function, _ = self.stages[stage_idx]
+        queue_in = self.queues[stage_idx]
+        queue_out = self.queues[stage_idx + 1]
+        while True:
+            packet = queue_in.get()
+            if packet is END:
+                break
+            t0 = time.time()
+            try:
+                function(packet)
+            except Exception as e:
+                self._fail(e)
+                break
+            packet.timestamps[name] = time.time()
+            self._count(name, t0)
+            queue_out.put(packet)
+
+        # The last worker of a stage forwards the end of the stream
+        with self.lock:
+            self.workers_done[stage_idx] += 1
+            last = self.workers_done[stage_idx] == self.stages[stage_idx][2]
+        if last:
+            next_workers = self.stages[stage_idx + 1][2] if stage_idx + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                queue_out.put(END, force=True)
+
+    def _count(self, name, t0):
+        with self.lock:
+            self.stats[name][0] += 1
+            self.stats[name][1] += time.time() - t0
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop()
+
+    def stop(self):
+        self.stopped.set()
+        for queue in self.queues:
+            queue.close()
+
+    def run(self, sink):
+
+        # Capture and the stages run on worker threads, the sink runs on the
+        # calling thread (GUI toolkits such as matplotlib need it). Returning
+        # False from the sink stops the pipeline.
+        threads = [threading.Thread(target=self._acquire, daemon=True)]
+        for stage_idx, (_, _, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self._work, args=(stage_idx,), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        self.start_time = time.time()
+        pending = []
+        next_seq = 0
+        keep_going = True
+        try:
+            while keep_going:
+                packet = self.queues[-1].get()
+                if packet is END:
+                    break
+                if not self.ordered:
+                    keep_going = self._emit(sink, packet)
+                    continue
+                # Release packets in capture order, skipping dropped ones
+                heapq.heappush(pending, (packet.seq, packet))
+                next_seq, keep_going = self._emitReady(sink, pending, next_seq)
+            # Flush what is left once the stream is over
+            while keep_going and pending:
+                _, packet = heapq.heappop(pending)
+                keep_going = self._emit(sink, packet)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def _emitReady(self, sink, pending, next_seq):
+        while pending:
+            with self.lock:
+                while next_seq in self.dropped:
+                    self.dropped.discard(next_seq)
+                    next_seq += 1
+            if pending[0][0] != next_seq:
+                break
+            _, packet = heapq.heappop(pending)
+            next_seq += 1
+            if not self._emit(sink, packet):
+                return next_seq, False
+        return next_seq, True
+
+    def _emit(self, sink, packet):
+        t0 = time.time()
+        keep_going = sink(packet)
+        packet.timestamps['output'] = time.time()
+        self._count('output', t0)
+        return keep_going is not False
+
+    def throughput(self):
+        # Frames per second delivered to the sink and mean time per stage
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            fps = self.stats['output'][0] / elapsed if elapsed > 0 else 0.0
+            stage_times = {name: (busy / count if count else 0.0) for name, (count, busy) in self.stats.items()}
+        return fps, stage_times
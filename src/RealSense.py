@@ -1,10 +1,19 @@
-import pyrealsense2 as rs
 import time
 import os
 
 import cv2
 import numpy as np
 
+from .Deproject import deprojectKeypointsFromDepth
+from .FrameCache import FrameCache
+
+# librealsense is only needed for live cameras and .bag playback, frame
+# caches are read without it
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
+
 class RealSense:
     
     def initRealSense(self, resolution = (640,480), fps = 60):
@@ -25,7 +34,10 @@ class RealSense:
         self.config.enable_stream(rs.stream.depth, res_x, res_y, rs.format.z16, fps)
         self.config.enable_stream(rs.stream.color, res_x, res_y, rs.format.bgr8, fps)
         
-        self.pipeline.start(self.config)
+        profile = self.pipeline.start(self.config)
+        
+        # Depth units to meters
+        self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
         
         # Depth jetmap init
         self.colorizer = rs.colorizer()
@@ -59,83 +71,119 @@ class RealSense:
         self.color_image_BGR = np.asanyarray(self.color_frame.get_data())    
 
         # Get color stream intrinsics
-        self.color_intrin = self.color_frame.profile.as_video_stream_profile().intrinsics 
+        self.setIntrinsics(self.color_frame.profile.as_video_stream_profile().intrinsics)
 
         # Aply jetmap to depth image for better visualization
         self.depth_colormap = np.asanyarray(self.colorizer.colorize(self.depth_frame).get_data())
 
         return self.color_image_BGR, self.depth_image   
 
+    def setIntrinsics(self, color_intrin):
+
+        self.color_intrin = color_intrin
+
+        # Array form of the intrinsics for the vectorized deprojection
+        cam_mtx = np.array([[color_intrin.fx, 0, color_intrin.ppx],
+                            [0, color_intrin.fy, color_intrin.ppy],
+                            [0, 0, 1]])
+        inverse_distortion = color_intrin.model == rs.distortion.inverse_brown_conrady
+        if color_intrin.model == rs.distortion.brown_conrady or inverse_distortion:
+            distortion = np.array(color_intrin.coeffs)
+        else:
+            distortion = None
+
+        self.setIntrinsicsArrays(cam_mtx, distortion, inverse_distortion)
+
+    def setIntrinsicsArrays(self, cam_mtx, distortion = None, inverse_distortion = False):
+        self.cam_mtx = cam_mtx
+        self.distortion = distortion
+        self.inverse_distortion = inverse_distortion
+
     def deprojectPose3D(self, keypoints2D):
 
         self.keypoints2D = keypoints2D
 
-        self.keypoints3D = np.ones((len(keypoints2D), 3)) * (-1)
-
-        for keypoint in range(len(keypoints2D)):
-            if(keypoints2D[keypoint][0] != -1):
-                x = np.int(keypoints2D[keypoint][0])
-                y = np.int(keypoints2D[keypoint][1])
-                self.keypoints3D[keypoint] = rs.rs2_deproject_pixel_to_point(self.color_intrin, [x,y], self.depth_frame.get_distance(x, y))
-            else:
-                self.keypoints3D[keypoint] = np.array([-1, -1, -1])
+        keypoints3D, _ = self.deprojectPoses3D(keypoints2D[np.newaxis])
+        self.keypoints3D = keypoints3D[0]
 
         return self.keypoints3D
+
+    def deprojectPoses3D(self, persons2D, depth_image = None):
+
+        # Deproject all persons at once from the depth image of the last
+        # frame (or the given one). Returns (N, K, 3) points in meters and
+        # an (N, K) validity mask.
+        if depth_image is None:
+            depth_image = self.depth_image
+
+        return deprojectKeypointsFromDepth(persons2D, depth_image, self.cam_mtx,
+                                           depth_scale=self.depth_scale, distortion=self.distortion,
+                                           inverse_distortion=self.inverse_distortion)
     
-    def initializeStreamFromBag(self, path_to_bag):
+    def initializeStreamFromBag(self, path_to_bag, stride = 1, start = None, end = None, real_time = False):
 
-        if os.path.splitext(path_to_bag)[1] != '.bag':
-            print("The given file is not of correct file format.")
-            print("Only .bag files are accepted")
-            exit()
-        
-        # Create pipeline
-        self.pipeline_bag = rs.pipeline()
+        # Playback runs as fast as frames are consumed unless real_time is
+        # set. stride keeps one frame set out of stride and start/end
+        # (seconds) restrict playback to a time window.
+        from .BagReader import BagReader
+        self.bag = BagReader(path_to_bag, stride=stride, start=start, end=end, real_time=real_time)
         
-        # Create a config object
-        config_bag = rs.config()
-        
-        # Tell config that we will use a recorded device from file to be used by the pipeline through playback.
-        rs.config.enable_device_from_file(config_bag, path_to_bag)
-        
-        # Configure the pipeline to stream the depth stream
-        # Change this parameters according to the recorded bag file resolution
-        # TODO: configurable parameters
-        config_bag.enable_stream(rs.stream.depth)
-        config_bag.enable_stream(rs.stream.color)
-        #config_bag.enable_all_streams()
-        
-        # Start streaming from file
-        self.pipeline_bag.start(config_bag)
+        # Depth units to meters
+        self.depth_scale = self.bag.depth_scale
         
         # Create colorizer object
         self.colorizer_bag = rs.colorizer()
+
+    def seekBag(self, seconds = None, frame_index = None):
+        # Exactly one of seconds / frame_index
+        if (seconds is None) == (frame_index is None):
+            raise ValueError("Seek needs either seconds or frame_index.")
+        if frame_index is not None:
+            self.bag.seekFrame(frame_index)
+        else:
+            self.bag.seekTime(seconds)
         
-        # Create an align object
-        align_to = rs.stream.color
-        self.align = rs.align(align_to)
-        
-    def getBagFrames(self):
+    def getBagFrames(self, colorize = True):
         
-        # Get frame set
-        frames = self.pipeline_bag.wait_for_frames()
-        
-        # Align frames
-        frames = self.align.process(frames)
+        # Aligned (color, depth) images, None at the end of the recording
+        images = self.bag.read()
+        if images is None:
+            return None
         
         # Get depth and color frame
-        self.depth_frame = frames.get_depth_frame()
-        self.color_frame = frames.get_color_frame()
+        self.depth_frame = self.bag.depth_frame
+        self.color_frame = self.bag.color_frame
         
         # Get color stream intrinsics
-        self.color_intrin = self.color_frame.profile.as_video_stream_profile().intrinsics
+        self.setIntrinsics(self.color_frame.profile.as_video_stream_profile().intrinsics)
         
         # Colorize depth frame to jet colormap
-        depth_colorized = self.colorizer_bag.colorize(self.depth_frame)
+        if colorize:
+            self.depth_colormap = np.asanyarray(self.colorizer_bag.colorize(self.depth_frame).get_data())
         
         # Get numpy format images
-        self.depth_colormap = np.asanyarray(depth_colorized.get_data())
-        self.depth_image = np.asanyarray(self.depth_frame.get_data())
-        self.color_image_BGR = np.asanyarray(self.color_frame.get_data())
+        self.color_image_BGR, self.depth_image = images
         
         return self.color_image_BGR, self.depth_image
+
+    def initializeStreamFromCache(self, path_to_cache, stride = 1, start = None, end = None):
+
+        # Frames pre-extracted by tools/extract_bag_frames.py, same stride and
+        # time window options as the bag playback
+        self.cache = FrameCache(path_to_cache, stride=stride, start=start, end=end)
+
+        # Recorded intrinsics replace the per-frame librealsense ones
+        self.depth_scale = self.cache.depth_scale
+        self.setIntrinsicsArrays(self.cache.cam_mtx, self.cache.distortion, self.cache.inverse_distortion)
+
+    def getCacheFrames(self):
+
+        # Read-only views of the memory mapped (color, depth) images, None at
+        # the end of the cache
+        images = self.cache.read()
+        if images is None:
+            return None
+
+        self.color_image_BGR, self.depth_image = images
+
+        return self.color_image_BGR, self.depth_image
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Append-only store of per-frame, per-person results. Records have a fixed
+# size and go into chunk files of chunk_size records that can be memory
+# mapped; index.json lists the chunks with their record count and frame and
+# sample id ranges, so a lookup only opens the chunks that may hold it.
+# Finished chunks also get a sorted (ids, rows) file per indexed field, so a
+# lookup inside a chunk is a binary search instead of a scan (records are
+# appended out of order by parallel runs).
+
+INDEX_FILE = 'index.json'
+INDEXED_FIELDS = ('frame', 'sample')
+
+def recordDtype(num_joints = 16):
+
+    return np.dtype([
+        ('frame', np.int64),          # frame number in the run
+        ('sample', np.int64),         # dataset sample / bag frame id
+        ('person', np.int32),         # index of the person in the frame
+        ('track_id', np.int64),       # -1 without tracking
+        ('kpts2D', np.float32, (num_joints, 2)),
+        ('kpts3D', np.float32, (num_joints, 3)),
+        ('fusion_flags', np.int8, (num_joints,)),
+        ('error', np.float32),        # mean error against annotation, NaN if none
+        ('error_per_joint', np.float32, (num_joints,)),
+        ('time', np.float32),         # processing time of the frame (s)
+    ])
+
+class ResultStore:
+
+    def __init__(self, path, mode = 'r', num_joints = 16, chunk_size = 65536, metadata = None):
+
+        # mode 'w' creates a new store, 'a' appends to an existing one and
+        # 'r' opens it read-only
+        self.path = path
+        self.mode = mode
+        self.chunk = None
+
+        if mode == 'w':
+            if os.path.exists(os.path.join(path, INDEX_FILE)):
+                raise Exception(f"Result store {path} already exists.")
+            os.makedirs(path, exist_ok=True)
+            self.index = {
+                'num_joints': num_joints,
+                'chunk_size': chunk_size,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'metadata': metadata or {},
+                'chunks': [],
+            }
+            self._writeIndex()
+        else:
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                self.index = json.load(f)
+            if metadata:
+                self.index['metadata'].update(metadata)
+
+        self.dtype = recordDtype(self.index['num_joints'])
+        self.chunk_size = self.index['chunk_size']
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.index['chunks'])
+
+    @property
+    def metadata(self):
+        return self.index['metadata']
+
+    def _writeIndex(self):
+        # Written to a temporary file and renamed, so a crash never leaves a
+        # truncated index
+        tmp_path = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def _openChunk(self, entry, mode):
+        return open_memmap(os.path.join(self.path, entry['file']), mode=mode)
+
+    def _sortedIndexPath(self, entry, field):
+        return os.path.join(self.path, entry['file'].replace('.npy', f'.{field}.npy'))
+
+    def _writeSortedIndex(self, entry, chunk):
+        # (2, count) array per field: the sorted ids and their chunk rows
+        records = chunk[:entry['count']]
+        for field in INDEXED_FIELDS:
+            order = np.argsort(records[field], kind='stable')
+            np.save(self._sortedIndexPath(entry, field), np.stack((records[field][order], order)))
+        entry['indexed'] = entry['count']
+
+    def _writableChunk(self):
+
+        chunks = self.index['chunks']
+        if chunks and chunks[-1]['count'] < self.chunk_size:
+            if self.chunk is None:
+                self.chunk = self._openChunk(chunks[-1], 'r+')
+            return chunks[-1]
+
+        # Start a new chunk, recording the previous one in the index
+        if self.chunk is not None:
+            self.chunk.flush()
+            self._writeSortedIndex(chunks[-1], self.chunk)
+        entry = {'file': f'chunk_{len(chunks):05d}.npy', 'count': 0,
+                 'frame_min': None, 'frame_max': None, 'sample_min': None, 'sample_max': None}
+        self.chunk = open_memmap(os.path.join(self.path, entry['file']), mode='w+', dtype=self.dtype, shape=(self.chunk_size,))
+        chunks.append(entry)
+        self._writeIndex()
+        return entry
+
+    def append(self, records):
+
+        # Append a structured array of records (see recordDtype)
+        if self.mode == 'r':
+            raise Exception("Result store opened read-only.")
+
+        start = 0
+        while start < len(records):
+            entry = self._writableChunk()
+            count = min(len(records) - start, self.chunk_size - entry['count'])
+            part = records[start:start + count]
+            self.chunk[entry['count']:entry['count'] + count] = part
+
+            entry['count'] += count
+            for field in ('frame', 'sample'):
+                low, high = int(part[field].min()), int(part[field].max())
+                entry[field + '_min'] = low if entry[field + '_min'] is None else min(entry[field + '_min'], low)
+                entry[field + '_max'] = high if entry[field + '_max'] is None else max(entry[field + '_max'], high)
+            start += count
+
+    def appendFrame(self, frame, sample = -1, persons2D = None, persons3D = None, fusion_flags = None,
+                    track_ids = None, errors = None, error_per_joint = None, elapsed = 0.0):
+
+        # One record per person of the frame. Missing fields are -1 (NaN for
+        # errors). A frame without persons is not stored.
+        given = [values for values in (persons2D, persons3D, errors) if values is not None]
+        num_persons = max((len(values) for values in given), default=0)
+        if num_persons == 0:
+            return
+
+        records = np.zeros(num_persons, dtype=self.dtype)
+        records['frame'] = frame
+        records['sample'] = sample
+        records['person'] = np.arange(num_persons)
+        records['time'] = elapsed
+        records['track_id'] = -1 if track_ids is None else track_ids
+        for field, values, default in (('kpts2D', persons2D, -1), ('kpts3D', persons3D, -1),
+                                       ('fusion_flags', fusion_flags, -1), ('error', errors, np.nan),
+                                       ('error_per_joint', error_per_joint, np.nan)):
+            records[field] = default if values is None or len(values) == 0 else values
+
+        self.append(records)
+
+    def flush(self):
+        if self.chunk is not None:
+            self.chunk.flush()
+            entry = self.index['chunks'][-1]
+            if entry.get('indexed') != entry['count']:
+                self._writeSortedIndex(entry, self.chunk)
+        if self.mode != 'r':
+            self._writeIndex()
+
+    def close(self):
+        self.flush()
+        self.chunk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def chunks(self):
+        # Read-only memory maps of the chunks, trimmed to their records
+        for entry in self.index['chunks']:
+            if entry['count'] > 0:
+                yield self._openChunk(entry, 'r')[:entry['count']]
+
+    def _select(self, field, low, high):
+        records = []
+        for entry in self.index['chunks']:
+            if entry['count'] == 0 or entry[field + '_max'] < low or entry[field + '_min'] > high:
+                continue
+            chunk = self._openChunk(entry, 'r')[:entry['count']]
+            if entry.get('indexed') == entry['count']:
+                ids, rows = np.load(self._sortedIndexPath(entry, field), mmap_mode='r')
+                start, end = np.searchsorted(ids, [low, high + 1])
+                records.append(chunk[np.sort(rows[start:end])])
+            else:
+                # Records appended since the last flush are not indexed yet
+                records.append(chunk[(chunk[field] >= low) & (chunk[field] <= high)])
+        if not records:
+            return np.zeros(0, dtype=self.dtype)
+        return np.concatenate(records)
+
+    def byFrame(self, frame, frame_to = None):
+        # Records of a frame, or of the frames in [frame, frame_to]
+        return self._select('frame', frame, frame if frame_to is None else frame_to)
+
+    def bySample(self, sample, sample_to = None):
+        return self._select('sample', sample, sample if sample_to is None else sample_to)
+
+    def column(self, field):
+        # A field of every record, e.g. column('error')
+        columns = [chunk[field] for chunk in self.chunks()]
+        if not columns:
+            return np.zeros((0,) + self.dtype[field].shape, dtype=self.dtype[field].base)
+        return np.concatenate(columns)
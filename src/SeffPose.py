@@ -1,12 +1,10 @@
-from numpy.core.arrayprint import _make_options_dict
-from numpy.lib.utils import _split_line
-from numpy.testing._private.nosetester import NoseTester
 import torch
-import torchvision
 import torch.nn as nn
 import os
 import numpy as np
 
+from .ModelRegistry import MODELS
+
 def weight_init(m):
     if isinstance(m, nn.Linear):
         nn.init.kaiming_normal(m.weight)
@@ -88,6 +86,59 @@ class LinearModel(nn.Module):
 
         return y
 
+def foldLinearBatchNorm(linear, batch_norm):
+    
+    # Linear followed by an eval-mode BatchNorm1d as a single Linear
+    scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale[:, None])
+        folded.bias.copy_((linear.bias - batch_norm.running_mean) * scale + batch_norm.bias)
+    
+    return folded
+
+class FoldedLinearModel(nn.Module):
+
+    # LinearModel for inference: BatchNorm folded into the Linear layers and
+    # dropout (identity in eval mode) removed
+    
+    def __init__(self, model):
+        super(FoldedLinearModel, self).__init__()
+
+        model = model.eval()
+        self.w1 = foldLinearBatchNorm(model.w1, model.batch_norm1)
+        self.stages_w1 = nn.ModuleList([foldLinearBatchNorm(stage.w1, stage.batch_norm1) for stage in model.linear_stages])
+        self.stages_w2 = nn.ModuleList([foldLinearBatchNorm(stage.w2, stage.batch_norm2) for stage in model.linear_stages])
+        self.w2 = nn.Linear(model.w2.in_features, model.w2.out_features)
+        self.w2.load_state_dict(model.w2.state_dict())
+
+        self.relu = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        y = self.relu(self.w1(x))
+
+        for w1, w2 in zip(self.stages_w1, self.stages_w2):
+            y = y + self.relu(w2(self.relu(w1(y))))
+
+        return self.w2(y)
+
+def optimizeLinearModel(model, quantize = True):
+
+    # Folded model, int8 dynamically quantized Linear layers (CPU only) and
+    # traced to TorchScript, ready for torch.jit.save
+    folded = FoldedLinearModel(model.cpu()).eval()
+    if quantize:
+        folded = torch.ao.quantization.quantize_dynamic(folded, {nn.Linear}, dtype=torch.qint8)
+    
+    with torch.inference_mode():
+        scripted = torch.jit.trace(folded, torch.zeros((2, model.input_size)))
+    
+    return torch.jit.freeze(scripted.eval())
+
+def optimizedPath(ckpt_path, quantize = True):
+    # human36_gt_iter200.pth.tar -> human36_gt_iter200.int8.pt
+    return ckpt_path.replace('.pth.tar', '.int8.pt' if quantize else '.folded.pt')
+
 class SeffPose:
     def __init__(self):
         
@@ -184,15 +235,15 @@ class SeffPose:
         
         return keypoints2D_MPII
 
-    def defineModel(self, net = "GT"):
-        # Set model arch
-        self.model = LinearModel()
+    def defineModel(self, net = "GT", optimized = False):
         
         # Choose pre-trained model: 'SH' or 'GT'
         self.net = net
+        # Use the folded int8 TorchScript model from tools/optimize_seffpose.py
+        self.optimized = optimized
         
-        # set the computation device
-        self.device = torch.device('cuda' if self.use_cuda else 'cpu')
+        # set the computation device (quantized models run on CPU)
+        self.device = torch.device('cuda' if self.use_cuda and not optimized else 'cpu')
         
         # Hydrapose path
         path = os.path.normpath(os.path.dirname(__file__)+os.sep+os.pardir)
@@ -200,30 +251,47 @@ class SeffPose:
             # Remove Neck/Nose from stat 2D
             self.stat2D_mean = np.delete(self.full_gtposeHM36m2D_mean, 9, 0)
             self.stat2D_std = np.delete(self.full_gtposeHM36m2D_std, 9, 0)
-            if not self.use_cuda:
-                
-                ckpt = torch.load(os.path.join(path, 'models', 'seffpose', 'human36_gt_iter200.pth.tar'),  map_location=torch.device('cpu'))
-            else:
-                ckpt = torch.load(os.path.join(path, 'models', 'seffpose', 'human36_gt_iter200.pth.tar'))
+            ckpt_path = os.path.join(path, 'models', 'seffpose', 'human36_gt_iter200.pth.tar')
 
         elif net == 'SH':
             # Adapt 2D stats for MPII entry
             self.stat2D_mean = self.HUMAN36MtoMPIIstats(self.full_gtposeHM36m2D_mean)
             self.stat2D_std = self.HUMAN36MtoMPIIstats(self.full_gtposeHM36m2D_std)
-            if not self.use_cuda:
-                ckpt = torch.load(os.path.join(path,'models','seffpose','hm36m_sh_iter138.pth.tar'), map_location=torch.device('cpu'))
-            else:
-                ckpt = torch.load(os.path.join(path,'models','seffpose','hm36m_sh_iter138.pth.tar'))
+            ckpt_path = os.path.join(path,'models','seffpose','hm36m_sh_iter138.pth.tar')
+        
+        # Model and statistics are loaded once per process and shared
+        if optimized:
+            optimized_path = optimizedPath(ckpt_path)
+            self.model = MODELS.get('SeffPose/int8', optimized_path, self.device,
+                                    lambda: torch.jit.load(optimized_path, map_location='cpu'), warmup=self._warmUpModel)
+        else:
+            self.model = MODELS.get('SeffPose', ckpt_path, self.device,
+                                    lambda: self._loadModel(ckpt_path), warmup=self._warmUpModel)
                 
         # Load statistics data
-        self.stat_3d = torch.load(os.path.join(path,'models','seffpose','stat_3d.pth.tar'))
+        stat_path = os.path.join(path,'models','seffpose','stat_3d.pth.tar')
+        self.stat_3d = MODELS.get('SeffPoseStats', stat_path, 'cpu', lambda: torch.load(stat_path))
+        
+        # 3D output columns kept after unnormalization (root + used dims)
+        self.dim_use_3D = np.hstack((np.arange(3), self.stat_3d['dim_use']))
+
+    def _loadModel(self, ckpt_path):
+        
+        # Set model arch
+        model = LinearModel()
+        ckpt = torch.load(ckpt_path, map_location=self.device)
         
         # Load the modle on to the computation device and set to eval mode
-        self.model.to(self.device).eval()
-        # print(stat_3d.keys())
-        # print(ckpt.keys())
+        model.to(self.device).eval()
+        model.load_state_dict(ckpt['state_dict'])
+        # Shared instances are read-only
+        model.requires_grad_(False)
+        
+        return model
 
-        self.model.load_state_dict(ckpt['state_dict'])
+    def _warmUpModel(self, model):
+        with torch.inference_mode():
+            model(torch.zeros((2, 32), device=self.device))
     
     def normalizePose2D(self, keypoints2D_HM36M, Width, Heigth):
         
@@ -255,6 +323,16 @@ class SeffPose:
         keypoints2D_norm = keypoints2D_norm / self.stat2D_std * 1000
         
         return keypoints2D_norm
+    
+    def normalizePoses2D(self, persons2D_HM36M, Width, Heigth):
+        
+        # Same as normalizePose2D for an (N, 16, 2) batch of persons
+        persons2D = np.asarray(persons2D_HM36M, dtype=np.float64) / np.array([Width, Heigth])
+        
+        # Normalize, broadcasting the stats over all persons
+        persons2D_norm = (persons2D - self.stat2D_mean/1000) / self.stat2D_std * 1000
+        
+        return persons2D_norm
         
     def unNormalizeData(self, normalized_data, data_mean, data_std, dimensions_to_use):
         T = normalized_data.shape[0]  # Batch size
@@ -264,33 +342,37 @@ class SeffPose:
 
         orig_data[:, dimensions_to_use] = normalized_data
 
-        # Multiply times stdev and add the mean
-        stdMat = data_std.reshape((1, D))
-        stdMat = np.repeat(stdMat, T, axis=0)
-        meanMat = data_mean.reshape((1, D))
-        meanMat = np.repeat(meanMat, T, axis=0)
-        orig_data = np.multiply(orig_data, stdMat) + meanMat
+        # Multiply times stdev and add the mean (broadcast over the batch)
+        orig_data = orig_data * data_std.reshape((1, D)) + data_mean.reshape((1, D))
         return orig_data
     
     def estimatePose3Dfrom2DKeypoints(self, keypoints2D):
         #keypoints2D = self.COCOtoMPII(keypoints2D)
         #self.keypoints2D = keypoints2D
         
-        keypoints2D = np.reshape(keypoints2D, (1,32))
+        keypoints3D = self.estimatePoses3Dfrom2DKeypoints(np.reshape(keypoints2D, (1, 16, 2)))
         
-        keypoints2D = keypoints2D.astype(np.float32)
+        return keypoints3D[0]
+
+    def estimatePoses3Dfrom2DKeypoints(self, persons2D_norm):
         
-        keypoints2D = torch.from_numpy(keypoints2D)
-        torch.no_grad()
-        outputs = self.model(keypoints2D)
+        # Lift all persons of a frame in a single (N, 32) forward pass
+        num_persons = len(persons2D_norm)
+        if num_persons == 0:
+            return np.zeros((0, 17, 3))
         
-        self.outputs = self.unNormalizeData(outputs.data.cpu().numpy(), self.stat_3d['mean'], self.stat_3d['std'], self.stat_3d['dim_use'])
+        keypoints2D = np.reshape(persons2D_norm, (num_persons, 32)).astype(np.float32)
+        keypoints2D = torch.from_numpy(keypoints2D).to(self.device)
         
-        # remove dim ignored
-        dim_use = np.hstack((np.arange(3), self.stat_3d['dim_use']))
+        with torch.inference_mode():
+            outputs = self.model(keypoints2D)
         
-        keypoints3D = self.outputs[:, dim_use]
-        keypoints3D = np.reshape(keypoints3D[0], (17,3))
+        outputs = self.unNormalizeData(outputs.cpu().numpy(), self.stat_3d['mean'], self.stat_3d['std'], self.stat_3d['dim_use'])
+        self.outputs = outputs
+        
+        # remove dim ignored
+        keypoints3D = outputs[:, self.dim_use_3D]
+        keypoints3D = np.reshape(keypoints3D, (num_persons, 17, 3))
         
         return keypoints3D
 
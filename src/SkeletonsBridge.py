@@ -1,4 +1,171 @@
 import numpy as np
+from collections import deque
+
+# Number of joints of each skeleton format
+SKELETON_JOINTS = {
+    'OpenPoseCOCO': 18,
+    'OpenPoseMPII': 16,
+    'COCO': 17,
+    'MPII': 16,
+    'HM36M': 16,
+    'MVOR': 10,
+}
+
+# Direct conversions between formats. Each output joint is either the index
+# of an input joint (plain copy) or a {input index: weight} dict for joints
+# derived as a weighted sum of input joints.
+SKELETON_CONVERSIONS = {
+    ('OpenPoseCOCO', 'COCO'): [
+        0,  # nose
+        15, # l_eye
+        14, # r_eye
+        17, # l_ear
+        16, # r_ear
+        5,  # l_shoulder
+        2,  # r_shoulder
+        6,  # l_elbow
+        3,  # r_elbow
+        7,  # l_wrist
+        4,  # r_wrist
+        11, # l_hip
+        8,  # r_hip
+        12, # l_knee
+        9,  # r_knee
+        13, # l_ankle
+        10, # r_ankle
+    ],
+    ('OpenPoseMPII', 'MPII'): [
+        10, # r_ankle
+        9,  # r_knee
+        8,  # r_hip
+        11, # l_hip
+        12, # l_knee
+        13, # l_ankle
+        {8: 0.5, 11: 0.5}, # pelvis = mean of hips
+        14, # mid_thorax
+        1,  # upper_neck
+        0,  # head_top
+        4,  # r_wrist
+        3,  # r_elbow
+        2,  # r_shoulder
+        5,  # l_shoulder
+        6,  # l_elbow
+        7,  # l_wrist
+    ],
+    ('COCO', 'MPII'): [
+        16, # r_ankle
+        14, # r_knee
+        12, # r_hip
+        11, # l_hip
+        13, # l_knee
+        15, # l_ankle
+        {11: 0.5, 12: 0.5}, # pelvis = mean of hips
+        {5: 0.5, 6: 0.5},   # upper_thorax = mean of shoulders
+        # upper_neck = upper_thorax + 0.3*(head_top - upper_thorax)
+        {5: 0.275, 6: 0.275, 0: 0.09, 1: 0.09, 2: 0.09, 3: 0.09, 4: 0.09},
+        # head_top = upper_thorax + 1.5*(head_center - upper_thorax),
+        # head_center being the mean of nose, eyes and ears
+        {5: -0.25, 6: -0.25, 0: 0.3, 1: 0.3, 2: 0.3, 3: 0.3, 4: 0.3},
+        10, # r_wrist
+        8,  # r_elbow
+        6,  # r_shoulder
+        5,  # l_shoulder
+        7,  # l_elbow
+        9,  # l_wrist
+    ],
+    ('MPII', 'HM36M'): [
+        6,  # pelvis
+        2,  # r_hip
+        1,  # r_knee
+        0,  # r_ankle
+        3,  # l_hip
+        4,  # l_knee
+        5,  # l_ankle
+        7,  # thorax
+        8,  # chest (upper_neck), neck/nose ignored
+        9,  # head_top
+        13, # l_shoulder
+        14, # l_elbow
+        15, # l_wrist
+        12, # r_shoulder
+        11, # r_elbow
+        10, # r_wrist
+    ],
+    ('HM36M', 'MVOR'): [
+        9,  # head_top (MVOR nose)
+        8,  # upper_neck
+        10, # l_shoulder
+        13, # r_shoulder
+        4,  # l_hip
+        1,  # r_hip
+        11, # l_elbow
+        14, # r_elbow
+        12, # l_wrist
+        15, # r_wrist
+    ],
+}
+
+class SkeletonMap:
+
+    # Linear map between two skeleton formats: persons_to = matrix @ persons_from
+
+    def __init__(self, matrix):
+        
+        self.matrix = matrix
+
+        # Maps made only of plain copies are applied as a gather
+        self.index = None
+        if np.all(np.count_nonzero(matrix, axis=1) == 1) and np.all(np.max(matrix, axis=1) == 1):
+            self.index = np.argmax(matrix, axis=1)
+
+    @classmethod
+    def fromTable(cls, table, num_joints_from):
+
+        matrix = np.zeros((len(table), num_joints_from))
+        for joint_to, joint_from in enumerate(table):
+            if isinstance(joint_from, dict):
+                for idx, weight in joint_from.items():
+                    matrix[joint_to, idx] = weight
+            else:
+                matrix[joint_to, joint_from] = 1.0
+        
+        return cls(matrix)
+
+    def compose(self, previous):
+        # Map equivalent to applying previous and then self
+        return SkeletonMap(self.matrix @ previous.matrix)
+
+    def apply(self, persons):
+        # Works on a single (K, D) person or an (N, K, D) batch
+        persons = np.asarray(persons, dtype=np.float64)
+        if self.index is not None:
+            return persons[..., self.index, :]
+        return np.matmul(self.matrix, persons)
+
+def _buildSkeletonMaps():
+
+    direct = {pair: SkeletonMap.fromTable(table, SKELETON_JOINTS[pair[0]])
+              for pair, table in SKELETON_CONVERSIONS.items()}
+
+    # Compose every reachable chain once, walking the conversion graph
+    # breadth first so the shortest chain is used
+    maps = {}
+    for typeFrom in SKELETON_JOINTS:
+        queue = deque([(typeFrom, None)])
+        visited = {typeFrom}
+        while queue:
+            typeCurr, mapCurr = queue.popleft()
+            for (a, b), mapNext in direct.items():
+                if a != typeCurr or b in visited:
+                    continue
+                composed = mapNext if mapCurr is None else mapNext.compose(mapCurr)
+                maps[(typeFrom, b)] = composed
+                visited.add(b)
+                queue.append((b, composed))
+    
+    return maps
+
+SKELETON_MAPS = _buildSkeletonMaps()
 
 class SkeletonsBridge:
     
@@ -59,323 +226,54 @@ class SkeletonsBridge:
         
         self.frame_tick = 0
 
-        self.the_bridge = []
+        self.the_bridge = SKELETON_MAPS
     
+    def getSkeletonMap(self, typeFrom, typeTo):
+        
+        if (typeFrom, typeTo) not in self.the_bridge:
+            raise Exception(f"No conversion from {typeFrom} to {typeTo}.")
+        
+        return self.the_bridge[(typeFrom, typeTo)]
+
     def changeSkeletonType(self, personsFrom, typeFrom, typeTo, allow_estimation=False):
         
-        num_of_persons = len(personsFrom)
-        fromBridge = self.the_bridge[typeFrom]
-        toBridge = self.the_bridge[typeTo]
+        skeleton_map = self.getSkeletonMap(typeFrom, typeTo)
 
-        num_of_joints_from = len(fromBridge)
-        num_of_joints_to = len(toBridge)
+        # Without estimation only joints present in the source may be used
+        if not allow_estimation and skeleton_map.index is None:
+            raise Exception(f"Converting {typeFrom} to {typeTo} needs estimated joints.")
 
-        if num_of_joints_from != num_of_joints_to:
-            raise Exception("Two types doesnt match.")
+        if len(personsFrom) == 0:
+            dims = np.shape(personsFrom)[-1] if np.ndim(personsFrom) == 3 else 2
+            return np.zeros((0, SKELETON_JOINTS[typeTo], dims))
 
-        personsTo = np.zeros(())
-        for idx, personFrom in enumerate(personsFrom):
-            pass
+        return skeleton_map.apply(personsFrom)
     
     def HM36MtoMVOR(self, keypoints3D_H36M):
-
-        # Set array
-        pelvis = keypoints3D_H36M[0] 
-        r_hip = keypoints3D_H36M[1] 
-        r_knee = keypoints3D_H36M[2] 
-        r_ankle = keypoints3D_H36M[3] 
-        l_hip = keypoints3D_H36M[4] 
-        l_knee = keypoints3D_H36M[5] 
-        l_ankle = keypoints3D_H36M[6] 
-        thorax = keypoints3D_H36M[7] 
-        # chest = keypoints3D_H36M[8] 
-        upper_neck = keypoints3D_H36M[8]
-        head_top = keypoints3D_H36M[9] 
-        l_shoulder = keypoints3D_H36M[10] 
-        l_elbow = keypoints3D_H36M[11] 
-        l_wrist = keypoints3D_H36M[12] 
-        r_shoulder = keypoints3D_H36M[13] 
-        r_elbow = keypoints3D_H36M[14] 
-        r_wrist = keypoints3D_H36M[15]
-
-        keypoints3D_MVOR = np.zeros((10,3))
-
-        # keypoints3D_MVOR[0] = nose # Right one
-        keypoints3D_MVOR[0] = head_top
-        keypoints3D_MVOR[1] = upper_neck
-        keypoints3D_MVOR[2] = l_shoulder
-        keypoints3D_MVOR[3] = r_shoulder
-        keypoints3D_MVOR[4] = l_hip
-        keypoints3D_MVOR[5] = r_hip
-        keypoints3D_MVOR[6] = l_elbow
-        keypoints3D_MVOR[7] = r_elbow
-        keypoints3D_MVOR[8] = l_wrist
-        keypoints3D_MVOR[9] = r_wrist
-
-        return keypoints3D_MVOR
-
+        return self.changeSkeletonType(keypoints3D_H36M, 'HM36M', 'MVOR', allow_estimation=True)
+    
     #MPII to HM36M 2D-> pose 2d input
     def MPIItoHM36M(self, keypoints2D_MPII):
         # MPII: http://human-pose.mpi-inf.mpg.de/#download
-        #
-        # Set array
-        r_ankle      = keypoints2D_MPII[0] 
-        r_knee       = keypoints2D_MPII[1] 
-        r_hip        = keypoints2D_MPII[2] 
-        l_hip        = keypoints2D_MPII[3] 
-        l_knee       = keypoints2D_MPII[4] 
-        l_ankle      = keypoints2D_MPII[5] 
-        pelvis       = keypoints2D_MPII[6] 
-        # upper_thorax = keypoints2D_MPII[7]
-        thorax = keypoints2D_MPII[7] 
-        upper_neck   = keypoints2D_MPII[8] 
-        head_top     = keypoints2D_MPII[9] 
-        r_wrist      = keypoints2D_MPII[10] 
-        r_elbow      = keypoints2D_MPII[11] 
-        r_shoulder   = keypoints2D_MPII[12] 
-        l_shoulder   = keypoints2D_MPII[13] 
-        l_elbow      = keypoints2D_MPII[14] 
-        l_wrist      = keypoints2D_MPII[15]
-        
-        # spine = upper_thorax + pelvis
-        # spine = spine / 2
-        
-        chest = upper_neck
-
-        # Init H3.6M keypoints without nose
-        keypoints2D_H36M = np.zeros((16,2))
-        # Set array
-        keypoints2D_H36M[0] = pelvis
-        keypoints2D_H36M[1] = r_hip
-        keypoints2D_H36M[2] = r_knee
-        keypoints2D_H36M[3] = r_ankle
-        keypoints2D_H36M[4] = l_hip
-        keypoints2D_H36M[5] = l_knee
-        keypoints2D_H36M[6] = l_ankle
-        keypoints2D_H36M[7] = thorax
-        keypoints2D_H36M[8] = chest
-        # neck/nose ignored  
-        keypoints2D_H36M[9] = head_top
-        keypoints2D_H36M[10] = l_shoulder
-        keypoints2D_H36M[11] = l_elbow
-        keypoints2D_H36M[12] = l_wrist
-        keypoints2D_H36M[13] = r_shoulder
-        keypoints2D_H36M[14] = r_elbow
-        keypoints2D_H36M[15] = r_wrist
-        
-        return keypoints2D_H36M
-        
+        return self.changeSkeletonType(keypoints2D_MPII, 'MPII', 'HM36M', allow_estimation=True)
+    
     def OpenPoseCOCOtoCOCO(self, keypoints2D_OpenPoseCOCO, output_format='MPII'):
-        
-        # Stacked Hourglass produces 16 joints. These are the names. Ref:https://github.com/una-dinosauria/3d-pose-baseline/blob/666080d86a96666d499300719053cc8af7ef51c8/src/data_utils.py#L16
-        # Seff uses MPI keypoints w/ 16 joints in this order
-        # [0]'RFoot'
-        # [1]'RKnee'
-        # [2]'RHip'
-        # [3]'LHip'
-        # [4]'LKnee'
-        # [5]'LFoot'
-        # [6]'Hip'
-        # [7]'Spine'
-        # [8]'Thorax'
-        # [9]'Head'
-        # [10]'RWrist'
-        # [11]'RElbow'
-        # [12]'RShoulder'
-        # [13]'LShoulder'
-        # [14]'LElbow'
-        # [15]'LWrist'
-        
-        nose = keypoints2D_OpenPoseCOCO[0]
-        upper_neck = keypoints2D_OpenPoseCOCO[1]
-        r_shoulder = keypoints2D_OpenPoseCOCO[2]
-        r_elbow = keypoints2D_OpenPoseCOCO[3]
-        r_wrist = keypoints2D_OpenPoseCOCO[4]
-        l_shoulder = keypoints2D_OpenPoseCOCO[5]
-        l_elbow = keypoints2D_OpenPoseCOCO[6]
-        l_wrist = keypoints2D_OpenPoseCOCO[7]
-        r_hip = keypoints2D_OpenPoseCOCO[8]
-        r_knee = keypoints2D_OpenPoseCOCO[9]
-        r_ankle = keypoints2D_OpenPoseCOCO[10]
-        l_hip = keypoints2D_OpenPoseCOCO[11]
-        l_knee = keypoints2D_OpenPoseCOCO[12]
-        l_ankle = keypoints2D_OpenPoseCOCO[13]
-        r_eye = keypoints2D_OpenPoseCOCO[14]
-        l_eye = keypoints2D_OpenPoseCOCO[15]
-        r_ear = keypoints2D_OpenPoseCOCO[16]
-        l_ear = keypoints2D_OpenPoseCOCO[17]
-        # Do not use
-        #background = keypoints2D_OpenPoseCOCO[18]
-        
-        # Init array
-        keypoints2D_COCO = np.zeros((17,2))
-        # Set array
-        keypoints2D_COCO[0]  = nose
-        keypoints2D_COCO[1] = l_eye
-        keypoints2D_COCO[2] = r_eye
-        keypoints2D_COCO[3] = l_ear
-        keypoints2D_COCO[4] = r_ear
-        keypoints2D_COCO[5] = l_shoulder 
-        keypoints2D_COCO[6] = r_shoulder 
-        keypoints2D_COCO[7] = l_elbow 
-        keypoints2D_COCO[8] = r_elbow 
-        keypoints2D_COCO[9] = l_wrist 
-        keypoints2D_COCO[10]= r_wrist 
-        keypoints2D_COCO[11] = l_hip 
-        keypoints2D_COCO[12] = r_hip 
-        keypoints2D_COCO[13] = l_knee 
-        keypoints2D_COCO[14] = r_knee 
-        keypoints2D_COCO[15] = l_ankle 
-        keypoints2D_COCO[16] = r_ankle 
-        
-        return keypoints2D_COCO
+        return self.changeSkeletonType(keypoints2D_OpenPoseCOCO, 'OpenPoseCOCO', 'COCO')
         
     def OpenPoseMPIItoMPII(self, keypoints2D_OpenPoseMPII):
-        
-        head_top = keypoints2D_OpenPoseMPII[0]
-        upper_neck = keypoints2D_OpenPoseMPII[1]
-        r_shoulder = keypoints2D_OpenPoseMPII[2]
-        r_elbow = keypoints2D_OpenPoseMPII[3]
-        r_wrist = keypoints2D_OpenPoseMPII[4]
-        l_shoulder = keypoints2D_OpenPoseMPII[5]
-        l_elbow = keypoints2D_OpenPoseMPII[6]
-        l_wrist = keypoints2D_OpenPoseMPII[7]
-        r_hip = keypoints2D_OpenPoseMPII[8]
-        r_knee = keypoints2D_OpenPoseMPII[9]
-        r_ankle = keypoints2D_OpenPoseMPII[10]
-        l_hip = keypoints2D_OpenPoseMPII[11]
-        l_knee = keypoints2D_OpenPoseMPII[12]
-        l_ankle = keypoints2D_OpenPoseMPII[13]
-        mid_thorax = keypoints2D_OpenPoseMPII[14]
-        # Do not use
-        background = keypoints2D_OpenPoseMPII[15]
-        
-        # Calculate pelvis
-        pelvis = l_hip + r_hip
-        pelvis = pelvis/2
-        
-        # Init MPII kpts
-        keypoints2D_MPII = np.zeros((16,2))
-        # Set array
-        keypoints2D_MPII[0] = r_ankle
-        keypoints2D_MPII[1] = r_knee
-        keypoints2D_MPII[2] = r_hip
-        keypoints2D_MPII[3] = l_hip
-        keypoints2D_MPII[4] = l_knee
-        keypoints2D_MPII[5] = l_ankle
-        keypoints2D_MPII[6] = pelvis
-        keypoints2D_MPII[7] = mid_thorax
-        keypoints2D_MPII[8] = upper_neck
-        keypoints2D_MPII[9] = head_top
-        keypoints2D_MPII[10] = r_wrist
-        keypoints2D_MPII[11] = r_elbow
-        keypoints2D_MPII[12] = r_shoulder
-        keypoints2D_MPII[13] = l_shoulder
-        keypoints2D_MPII[14] = l_elbow
-        keypoints2D_MPII[15] = l_wrist
-        
-        return keypoints2D_MPII
-        # pelvis = keypoints2D_OpenPoseMPII[8]/2 + keypoints2D_OpenPoseMPII[11]/2
-        # self.keypoints2D_Baseline = np.array([keypoints2D_OpenPoseMPII[10], keypoints2D_OpenPoseMPII[9], keypoints2D_OpenPoseMPII[8],
-        #                                         keypoints2D_OpenPoseMPII[11], keypoints2D_OpenPoseMPII[12], keypoints2D_OpenPoseMPII[13],
-        #                                         pelvis, keypoints2D_OpenPoseMPII[15], keypoints2D_OpenPoseMPII[1],
-        #                                         keypoints2D_OpenPoseMPII[0], keypoints2D_OpenPoseMPII[4], keypoints2D_OpenPoseMPII[3],
-        #                                         keypoints2D_OpenPoseMPII[2], keypoints2D_OpenPoseMPII[5], keypoints2D_OpenPoseMPII[6],
-        #                                         keypoints2D_OpenPoseMPII[15]])
+        return self.changeSkeletonType(keypoints2D_OpenPoseMPII, 'OpenPoseMPII', 'MPII', allow_estimation=True)
     
     def COCOtoMPII(self, keypoints2D_COCO):
-    
         # COCO:
         #https://www.immersivelimit.com/tutorials/create-coco-annotations-from-scratch
-        # "nose",        "left_eye",      "right_eye",      "left_ear",
-        # "right_ear",   "left_shoulder", "right_shoulder", "left_elbow",
-        # "right_elbow", "left_wrist",    "right_wrist",    "left_hip", 
-        # "right_hip",   "left_knee",     "right_knee",     "left_ankle",
-        # "right_ankle"
-
-        # Set auxiliar variables
-        nose = keypoints2D_COCO[0]
-        l_eye = keypoints2D_COCO[1]
-        r_eye = keypoints2D_COCO[2]
-        l_ear = keypoints2D_COCO[3]
-        r_ear = keypoints2D_COCO[4]
-        l_shoulder = keypoints2D_COCO[5]
-        r_shoulder = keypoints2D_COCO[6]
-        l_elbow = keypoints2D_COCO[7]
-        r_elbow = keypoints2D_COCO[8]
-        l_wrist = keypoints2D_COCO[9]
-        r_wrist = keypoints2D_COCO[10]
-        l_hip = keypoints2D_COCO[11]
-        r_hip = keypoints2D_COCO[12]
-        l_knee = keypoints2D_COCO[13]
-        r_knee = keypoints2D_COCO[14]
-        l_ankle = keypoints2D_COCO[15]
-        r_ankle = keypoints2D_COCO[16]
-        
         # MPII:
         #http://human-pose.mpi-inf.mpg.de/#download
-        #  r ankle,    r knee,     r hip,   l hip,
-        #  l knee,     l ankle,    pelvis,  thorax,
-        #  upper neck, head top,   r wrist, r elbow,
-        #  r shoulder, l shoulder, l elbow, l wrist
-        
-        # Calculate pelvis
-        pelvis = l_hip + r_hip
-        pelvis = pelvis/2
-        
-        # Calculate upper_thorax
-        upper_thorax = r_shoulder + l_shoulder
-        upper_thorax = upper_thorax/2
-        
-        # Calculate head_top
-        head_center = nose + r_ear + l_ear + r_eye + l_eye
-        head_center = head_center/5
-        vector_head = head_center - upper_thorax
-        head_top = upper_thorax + 1.5*vector_head
-        
-        # Calculate upper_neck
-        upper_neck_vec = head_top - upper_thorax
-        upper_neck = upper_thorax + 0.3 * upper_neck_vec
-        
-        # Init MPII kpts
-        keypoints2D_MPII = np.zeros((16,2))
-        
-        # Set array
-        keypoints2D_MPII[0] = r_ankle
-        keypoints2D_MPII[1] = r_knee
-        keypoints2D_MPII[2] = r_hip
-        keypoints2D_MPII[3] = l_hip
-        keypoints2D_MPII[4] = l_knee
-        keypoints2D_MPII[5] = l_ankle
-        keypoints2D_MPII[6] = pelvis
-        keypoints2D_MPII[7] = upper_thorax
-        keypoints2D_MPII[8] = upper_neck
-        keypoints2D_MPII[9] = head_top
-        keypoints2D_MPII[10] = r_wrist
-        keypoints2D_MPII[11] = r_elbow
-        keypoints2D_MPII[12] = r_shoulder
-        keypoints2D_MPII[13] = l_shoulder
-        keypoints2D_MPII[14] = l_elbow
-        keypoints2D_MPII[15] = l_wrist
-        
-        return keypoints2D_MPII
+        return self.changeSkeletonType(keypoints2D_COCO, 'COCO', 'MPII', allow_estimation=True)
     
     def transformPersonsFromTo(self, persons2D_from, mode_from, mode_to):
-        persons2D_to = []
-        if mode_from == 'COCO' and mode_to == 'HM36M':
-            for person2D in persons2D_from:
-                person2D = self.COCOtoMPII(person2D)
-                person2D = self.MPIItoHM36M(person2D)
-                persons2D_to.append(person2D)
-        elif mode_from == 'OpenPoseCOCO' and mode_to == 'HM36M':
-            for person2D in persons2D_from:
-                person2D = self.OpenPoseCOCOtoCOCO(person2D)
-                person2D = self.COCOtoMPII(person2D)
-                person2D = self.MPIItoHM36M(person2D)
-                persons2D_to.append(person2D)
-        else:
-            print("Mode doesnt match")
-        return np.array(persons2D_to)
+        # Chains like COCO -> MPII -> HM36M are composed once at import time,
+        # so the whole batch is converted by a single gather or matmul
+        return self.changeSkeletonType(persons2D_from, mode_from, mode_to, allow_estimation=True)
 
 
     def preNormalizeKeypoints(self, image, keypoints2D):
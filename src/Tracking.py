@@ -0,0 +1,119 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from .Person import Person, Frame
+
+# Cost of a detection-track pair that is not allowed to match
+INFEASIBLE = 1e6
+
+def keypointDistances(personsA, personsB):
+
+    # (NA, NB) mean distance between the joints present (not -1) in both
+    # persons, inf when they share no joint
+    personsA = np.asarray(personsA, dtype=np.float64)[:, np.newaxis]
+    personsB = np.asarray(personsB, dtype=np.float64)[np.newaxis]
+    shared = np.any(personsA != -1, axis=-1) & np.any(personsB != -1, axis=-1)
+    distances = np.linalg.norm(personsA - personsB, axis=-1)
+    count = shared.sum(axis=-1)
+    total = np.where(shared, distances, 0).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 0, total / count, np.inf)
+
+def centroids(persons):
+    # (N, 3) mean of the joints present, NaN for persons without any
+    persons = np.asarray(persons, dtype=np.float64)
+    valid = np.any(persons != -1, axis=-1)
+    count = valid.sum(axis=-1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid[..., np.newaxis], persons, 0).sum(axis=1) / count
+
+class PersonTracker:
+
+    # Associates the persons detected on each frame to persistent Person
+    # tracks with the Hungarian algorithm, on 2D keypoint distance plus 3D
+    # centroid distance when 3D poses are given
+
+    def __init__(self, max_distance2D = 100, max_distance3D = 500, max_missed = 10):
+
+        # Pairs further apart than these (pixels / milimiters) never match
+        self.max_distance2D = max_distance2D
+        self.max_distance3D = max_distance3D
+        # Tracks unmatched for more frames than this are dropped
+        self.max_missed = max_missed
+
+        self.tracks = []
+        self.next_id = 0
+
+    def reset(self):
+        self.tracks = []
+        self.next_id = 0
+
+    def costMatrix(self, persons2D, persons3D = None):
+
+        # (N detections, M tracks), each term normalized by its gate
+        tracks2D = [track.kpts2D for track in self.tracks]
+        cost = keypointDistances(persons2D, tracks2D) / self.max_distance2D
+        gated = cost > 1
+
+        tracks3D = [track.kpts3D for track in self.tracks]
+        if persons3D is not None and all(kpts3D is not None for kpts3D in tracks3D):
+            cost3D = np.linalg.norm(centroids(persons3D)[:, np.newaxis] - centroids(tracks3D)[np.newaxis], axis=-1)
+            cost3D = cost3D / self.max_distance3D
+            # Without a usable centroid the 2D term decides alone
+            known = np.isfinite(cost3D)
+            gated |= known & (cost3D > 1)
+            cost = cost + np.where(known, cost3D, 0)
+
+        return np.where(gated, INFEASIBLE, cost)
+
+    def update(self, persons2D, persons3D = None):
+
+        # Returns the (N,) track ids of the detections, in detection order
+        num_persons = len(persons2D)
+        ids = np.full(num_persons, -1, dtype=int)
+        matched_tracks = set()
+
+        if num_persons > 0 and len(self.tracks) > 0:
+            cost = self.costMatrix(persons2D, persons3D)
+            rows, cols = linear_sum_assignment(cost)
+            for row, col in zip(rows, cols):
+                if cost[row, col] >= INFEASIBLE:
+                    continue
+                ids[row] = self.tracks[col].id
+                matched_tracks.add(col)
+                self._updateTrack(self.tracks[col], persons2D[row], None if persons3D is None else persons3D[row])
+
+        # Unmatched tracks age, unmatched detections start new tracks
+        for col, track in enumerate(self.tracks):
+            if col not in matched_tracks:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        for row in np.flatnonzero(ids == -1):
+            track = Person()
+            track.id = self.next_id
+            track.frame = Frame.CAM
+            self.next_id += 1
+            self._updateTrack(track, persons2D[row], None if persons3D is None else persons3D[row])
+            self.tracks.append(track)
+            ids[row] = track.id
+
+        return ids
+
+    def _updateTrack(self, track, kpts2D, kpts3D):
+        track.kpts2D = np.array(kpts2D, dtype=np.float64)
+        if kpts3D is not None:
+            track.kpts3D = np.array(kpts3D, dtype=np.float64)
+        track.missed = 0
+        track.hits += 1
+
+    def setPoses3D(self, ids, persons3D):
+        # Store the final 3D poses of the persons tracked this frame
+        tracks = {track.id: track for track in self.tracks}
+        for person_id, kpts3D in zip(ids, persons3D):
+            tracks[person_id].kpts3D = np.array(kpts3D, dtype=np.float64)
+
+    def getPersons(self, ids):
+        # Person objects for the given track ids
+        tracks = {track.id: track for track in self.tracks}
+        return [tracks[person_id] for person_id in ids]
@@ -2,6 +2,7 @@ import time
 import cv2
 import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 from matplotlib import pyplot as plt
 import sys
 
@@ -13,6 +14,14 @@ class Visualizer:
         self.bridge = SkeletonsBridge()
         self.skeleton_color = 'dodgerblue'
         self.camma_colors_skeleton = ['y', 'g', 'g', 'g', 'g', 'm', 'm', 'm', 'm', 'm']
+
+        # Real-time mode artists, created once and updated in place
+        self.image_artist = None
+        self.depth_artist = None
+        self.person_lines = []
+        self.background = None
+        self.use_blit = True
+        self.realtime_ready = False
     
     def init3D(self, total, pos, ground = False):
         # 3D plot axis
@@ -160,8 +169,102 @@ class Visualizer:
         
         return ax3D
     
+    def getPairs3D(self, mode = 'Human36M'):
+
+        color = []
+        if mode == 'Human36M':
+            pairs = self.bridge.pairs_upper_Human36M_noseless
+        elif mode == 'MVOR':
+            pairs = self.bridge.pairs_MVOR
+            color = self.camma_colors_skeleton
+        
+        return pairs, color
+
+    def initRealtime(self, blit = True):
+
+        # Artists are animated so full redraws skip them and the cached
+        # background only holds the static parts (axes, grid, labels)
+        self.use_blit = blit and self.fig.canvas.supports_blit
+        self.fig.canvas.mpl_connect('draw_event', self._onDraw)
+        plt.show(block=False)
+        self.fig.canvas.draw()
+        self.realtime_ready = True
+
+    def _onDraw(self, event):
+        if self.use_blit:
+            self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _updateImageArtist(self, ax, artist, image):
+        if artist is None or artist.get_array().shape != image.shape:
+            if artist is not None:
+                artist.remove()
+            artist = ax.imshow(image, animated=self.use_blit)
+            self.background = None
+        else:
+            artist.set_data(image)
+        return artist
+
+    def showRealtime(self, image, persons3D, depth = None, mode = 'Human36M'):
+
+        if not self.realtime_ready:
+            self.initRealtime(blit=self.use_blit)
+
+        self.image_artist = self._updateImageArtist(self.axImage, self.image_artist, image)
+        if depth is not None and hasattr(self, 'axDepth'):
+            self.depth_artist = self._updateImageArtist(self.axDepth, self.depth_artist, depth)
+
+        pairs, color = self.getPairs3D(mode)
+        pairs = np.array(pairs)
+        colors = np.array(color if color else ['red'] * len(pairs))
+
+        # One line collection per person, only grown when more persons appear
+        while len(self.person_lines) < len(persons3D):
+            lines = Line3DCollection([], animated=self.use_blit)
+            self.ax3D.add_collection(lines, autolim=False)
+            self.person_lines.append(lines)
+            self.background = None
+
+        for idx, lines in enumerate(self.person_lines):
+            if idx >= len(persons3D):
+                lines.set_segments([])
+                continue
+            # Bones of the person as (pairs, 2, 3), skipping missing joints
+            segments = np.asarray(persons3D[idx])[pairs]
+            keep = ~np.any(segments == -1, axis=(1, 2))
+            lines.set_segments(segments[keep])
+            lines.set_color(colors[keep])
+
+        canvas = self.fig.canvas
+        if self.use_blit:
+            if self.background is None:
+                # New artists: refresh the cached background first
+                canvas.draw()
+            canvas.restore_region(self.background)
+            self.axImage.draw_artist(self.image_artist)
+            if self.depth_artist is not None:
+                self.axDepth.draw_artist(self.depth_artist)
+            for lines in self.person_lines:
+                self._project3D(lines)
+                self.ax3D.draw_artist(lines)
+            canvas.blit(self.fig.bbox)
+        else:
+            canvas.draw_idle()
+        canvas.flush_events()
+
+    def _project3D(self, lines):
+        # Older matplotlib versions take the renderer as argument
+        try:
+            lines.do_3d_projection()
+        except TypeError:
+            lines.do_3d_projection(self.fig.canvas.get_renderer())
+
     def show(self, image, persons3D, depth=[], block = False, mode = 'Human36M'):
         
+        # Live loops update persistent artists instead of replotting
+        if block is False:
+            self.showRealtime(image, persons3D, depth=depth if len(depth) else None, mode=mode)
+            return
+        
         # image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         image_rgb = image
         self.axImage.imshow(image_rgb)
@@ -203,12 +306,6 @@ class Visualizer:
         # Display 3D plot
         plt.show(block=block)
         
-        if block is False:
-            plt.pause(1)
-
-        if block is True:
-            plt.pause(-1)
-        
     def comparePlot3D(self, persons1, persons2):
 
         fig = plt.figure()
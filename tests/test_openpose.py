@@ -0,0 +1,42 @@
+import numpy as np
+
+from src.OpenPose import OpenPose
+
+def makeOpenPose(width, height):
+    op = OpenPose()
+    op.frameWidth = width
+    op.frameHeight = height
+    return op
+
+def test_plateau_gives_one_keypoint():
+    # A 2x2 flat maximum is a single body part candidate
+    probMaps = np.zeros((2, 20, 20), np.float32)
+    probMaps[0, 5:7, 8:10] = 1.0
+    probMaps[1, 12, 3] = 1.0
+    op = makeOpenPose(20, 20)
+
+    keypoints = op._getKeypoints(probMaps, refine=False)
+
+    assert len(keypoints[0]) == 1
+    assert keypoints[0][0][:2] == (8.0, 5.0)
+    assert len(keypoints[1]) == 1
+
+def test_plateau_refined_to_its_center():
+    probMaps = np.zeros((1, 20, 20), np.float32)
+    probMaps[0, 5:7, 8:10] = 1.0
+    op = makeOpenPose(20, 20)
+
+    (x, y, _), = op._getKeypoints(probMaps)[0]
+
+    assert np.isclose(x, 8.5) and np.isclose(y, 5.5)
+
+def test_separate_peaks_are_kept():
+    probMaps = np.zeros((1, 20, 20), np.float32)
+    probMaps[0, 3, 3] = 1.0
+    probMaps[0, 3, 10] = 1.0
+    probMaps[0, 15, 3] = 0.5
+    op = makeOpenPose(20, 20)
+
+    keypoints = op._getKeypoints(probMaps, refine=False)[0]
+
+    assert sorted(k[:2] for k in keypoints) == [(3.0, 3.0), (3.0, 15.0), (10.0, 3.0)]
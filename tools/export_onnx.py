@@ -0,0 +1,147 @@
+import os
+import sys
+import inspect
+import argparse
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.KeypointRCNN import ONNX_FILE as KEYPOINTRCNN_ONNX, ONNX_OUTPUTS as KEYPOINTRCNN_OUTPUTS
+
+# Exports the 2D detectors to ONNX for the onnxruntime inference backend.
+# OpenCV cannot write ONNX, so the OpenPose Caffe network is rebuilt in torch
+# with the weights read through cv2.dnn and exported from there.
+
+OPENPOSE_PROTO = "models/openpose/coco/pose_deploy_linevec.prototxt"
+OPENPOSE_WEIGHTS = "models/openpose/coco/pose_iter_440000.caffemodel"
+OPENPOSE_ONNX = "models/openpose/coco/pose_coco.onnx"
+
+# VGG-19 front end of the COCO model, None being a 2x2 max pooling
+OPENPOSE_FEATURES = ['conv1_1', 'conv1_2', None, 'conv2_1', 'conv2_2', None,
+                     'conv3_1', 'conv3_2', 'conv3_3', 'conv3_4', None,
+                     'conv4_1', 'conv4_2', 'conv4_3_CPM', 'conv4_4_CPM']
+
+def openPoseBranch(stage, branch):
+    # Layer names of one branch (L1 PAFs, L2 heatmaps) of one stage
+    if stage == 1:
+        return [f'conv5_{i}_CPM_L{branch}' for i in range(1, 6)]
+    return [f'Mconv{i}_stage{stage}_L{branch}' for i in range(1, 8)]
+
+def onnxExport(model, args, path, input_names, output_names, dynamic_axes, opset):
+    # Keep the TorchScript exporter where torch defaults to the dynamo one
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.onnx.export(model, args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, **kwargs)
+    print(f"Saved {path}")
+
+class OpenPoseCOCONet(nn.Module):
+
+    # OpenPose COCO network (VGG front end and 6 two-branch stages). Output is
+    # the Caffe concat_stage7: 19 heatmaps followed by 38 PAF channels.
+
+    def __init__(self, getWeights, stages = 6):
+        super(OpenPoseCOCONet, self).__init__()
+
+        self.stages = stages
+        self.layers = nn.ModuleDict()
+        for name in OPENPOSE_FEATURES:
+            if name is not None:
+                self.layers[name] = self._conv(getWeights(name))
+        for stage in range(1, stages + 1):
+            for branch in (1, 2):
+                for name in openPoseBranch(stage, branch):
+                    self.layers[name] = self._conv(getWeights(name))
+
+        # Caffe rounds pooled sizes up
+        self.pool = nn.MaxPool2d(2, 2, ceil_mode=True)
+        self.relu = nn.ReLU(inplace=True)
+
+    def _conv(self, weights):
+        weight, bias = weights
+        out_channels, in_channels, k, _ = weight.shape
+        conv = nn.Conv2d(in_channels, out_channels, k, padding=k // 2)
+        conv.weight.data.copy_(torch.from_numpy(weight.reshape(conv.weight.shape)))
+        conv.bias.data.copy_(torch.from_numpy(bias.reshape(-1)))
+        return conv
+
+    def _branch(self, x, names):
+        for name in names[:-1]:
+            x = self.relu(self.layers[name](x))
+        return self.layers[names[-1]](x)
+
+    def forward(self, x):
+
+        for name in OPENPOSE_FEATURES:
+            x = self.pool(x) if name is None else self.relu(self.layers[name](x))
+        features = x
+
+        pafs = self._branch(features, openPoseBranch(1, 1))
+        heatmaps = self._branch(features, openPoseBranch(1, 2))
+        for stage in range(2, self.stages + 1):
+            x = torch.cat([pafs, heatmaps, features], 1)
+            pafs = self._branch(x, openPoseBranch(stage, 1))
+            heatmaps = self._branch(x, openPoseBranch(stage, 2))
+
+        return torch.cat([heatmaps, pafs], 1)
+
+def caffeWeights(net):
+    def getWeights(name):
+        layer_id = net.getLayerId(name)
+        return np.float32(net.getParam(layer_id, 0)), np.float32(net.getParam(layer_id, 1))
+    return getWeights
+
+def exportOpenPose(path, opset, check):
+
+    net = cv2.dnn.readNetFromCaffe(OPENPOSE_PROTO, OPENPOSE_WEIGHTS)
+    model = OpenPoseCOCONet(caffeWeights(net)).eval()
+
+    # Same input as OpenPose.estimate2DPose
+    blob = np.random.default_rng(0).random((1, 3, 363, 363), dtype=np.float32)
+
+    if check:
+        net.setInput(blob)
+        reference = net.forward()
+        with torch.inference_mode():
+            rebuilt = model(torch.from_numpy(blob)).numpy()
+        print(f"Rebuilt network max abs error vs OpenCV: {np.abs(reference - rebuilt).max():.2e}")
+
+    onnxExport(model, (torch.from_numpy(blob),), path, ['image'], ['output'],
+               {'image': {2: 'height', 3: 'width'}, 'output': {2: 'out_height', 3: 'out_width'}}, opset)
+
+def exportKeypointRCNN(path, opset, check):
+
+    model = torchvision.models.detection.keypointrcnn_resnet50_fpn(pretrained=True, num_keypoints=17).eval()
+
+    # Same input as KeypointRCNN._framesToTensor: one RGB (3, H, W) image in [0, 1]
+    image = torch.rand(3, 480, 640)
+    dynamic_axes = {'image': {1: 'height', 2: 'width'}}
+    dynamic_axes.update({name: {0: 'persons'} for name in KEYPOINTRCNN_OUTPUTS})
+    onnxExport(model, ([image],), path, ['image'], KEYPOINTRCNN_OUTPUTS, dynamic_axes, opset)
+
+    if check:
+        from src.InferenceBackend import OnnxRuntimeBackend
+        with torch.inference_mode():
+            reference = model([image])[0]
+        outputs = dict(zip(KEYPOINTRCNN_OUTPUTS, OnnxRuntimeBackend(path).run([image.numpy()])))
+        print(f"Persons torch / onnxruntime: {len(reference['scores'])} / {len(outputs['scores'])}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export the 2D pose detectors to ONNX.")
+    parser.add_argument('model', choices=['openpose', 'keypointrcnn'])
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--opset', type=int, default=11)
+    parser.add_argument('--check', action='store_true', help="compare the exported network with the original one")
+    args = parser.parse_args()
+
+    if args.model == 'openpose':
+        exportOpenPose(args.output or OPENPOSE_ONNX, args.opset, args.check)
+    else:
+        exportKeypointRCNN(args.output or KEYPOINTRCNN_ONNX, args.opset, args.check)
@@ -0,0 +1,59 @@
+import os
+import sys
+import math
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.RealSense import RealSense
+from src.FrameCache import FrameCacheWriter
+
+# Decodes and aligns a RealSense .bag once and writes its frames into a
+# memory mapped frame cache (src/FrameCache.py) for repeated runs.
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Extract aligned frames of a RealSense bag to a frame cache.")
+    parser.add_argument('bag')
+    parser.add_argument('output', help="frame cache directory")
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--start', type=float, default=None, help="start time (s)")
+    parser.add_argument('--end', type=float, default=None, help="end time (s)")
+    args = parser.parse_args()
+
+    rlsns = RealSense()
+    rlsns.initializeStreamFromBag(args.bag, stride=args.stride, start=args.start, end=args.end)
+    bag = rlsns.bag
+
+    writer = None
+    while True:
+        frames = rlsns.getBagFrames(colorize=False)
+        if frames is None:
+            break
+        color_image, depth_image = frames
+
+        if writer is None:
+            # Intrinsics and depth scale are fixed for a recording
+            start = args.start or 0
+            end = bag.duration if args.end is None else min(args.end, bag.duration)
+            capacity = math.ceil((end - start) * bag.fps / args.stride * 1.05) + 1
+            meta = {
+                'bag': os.path.abspath(args.bag),
+                'fps': bag.fps / args.stride,
+                'stride': args.stride,
+                'depth_scale': rlsns.depth_scale,
+                'cam_mtx': rlsns.cam_mtx.tolist(),
+                'distortion': None if rlsns.distortion is None else rlsns.distortion.tolist(),
+                'inverse_distortion': bool(rlsns.inverse_distortion),
+            }
+            writer = FrameCacheWriter(args.output, color_image.shape, depth_image.shape, capacity, meta)
+
+        writer.append(color_image, depth_image, bag.timestamp, bag.frame_index)
+        if writer.count % 300 == 0:
+            print(f"{writer.count} frames, t = {bag.timestamp:.1f} s")
+
+    bag.close()
+    if writer is None:
+        print("No frames extracted.")
+    else:
+        writer.close()
+        print(f"Extracted {writer.count} frames to {args.output}")
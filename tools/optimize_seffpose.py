@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.SeffPose import SeffPose, FoldedLinearModel, optimizeLinearModel, optimizedPath
+
+# Builds the folded int8 TorchScript SeffPose model loaded by
+# SeffPose.defineModel(optimized=True) and reports how far its 3D poses are
+# from the fp32 checkpoint.
+
+def lift(seff, model, inputs):
+    # Normalized (N, 32) 2D inputs to (N, 17, 3) poses in millimeters
+    with torch.inference_mode():
+        outputs = model(torch.from_numpy(inputs)).numpy()
+    outputs = seff.unNormalizeData(outputs, seff.stat_3d['mean'], seff.stat_3d['std'], seff.stat_3d['dim_use'])
+    return outputs[:, seff.dim_use_3D].reshape(len(inputs), 17, 3)
+
+def mpjpe(poses, reference):
+    # Root relative mean per joint position error
+    poses = poses - poses[:, :1]
+    reference = reference - reference[:, :1]
+    return np.mean(np.linalg.norm(poses - reference, axis=-1))
+
+def timeModel(model, inputs, repeats = 50):
+    with torch.inference_mode():
+        model(inputs)
+        t0 = time.time()
+        for _ in range(repeats):
+            model(inputs)
+    return (time.time() - t0) / repeats
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fold, quantize and script the SeffPose model.")
+    parser.add_argument('--net', choices=['GT', 'SH'], default='GT')
+    parser.add_argument('--inputs', default=None,
+                        help="(N, 32) or (N, 16, 2) normalized 2D poses (.npy) for the parity check, random if not given")
+    parser.add_argument('--targets', default=None, help="(N, 17, 3) ground truth 3D poses in mm (.npy)")
+    parser.add_argument('--no-quantize', dest='quantize', action='store_false', help="only fold and script")
+    args = parser.parse_args()
+
+    # fp32 reference on CPU, loaded the same way HydraPose does
+    seff = SeffPose()
+    seff.use_cuda = False
+    seff.defineModel(args.net)
+    model = seff.model.cpu().eval()
+    ckpt_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models', 'seffpose',
+                             'human36_gt_iter200.pth.tar' if args.net == 'GT' else 'hm36m_sh_iter138.pth.tar')
+
+    optimized = optimizeLinearModel(model, quantize=args.quantize)
+    path = optimizedPath(ckpt_path, quantize=args.quantize)
+    torch.jit.save(optimized, path)
+    print(f"Saved {path}")
+
+    # Parity check
+    if args.inputs is not None:
+        inputs = np.load(args.inputs).reshape(-1, 32).astype(np.float32)
+    else:
+        inputs = np.random.default_rng(0).standard_normal((4096, 32), dtype=np.float32)
+
+    poses_fp32 = lift(seff, model, inputs)
+    poses_folded = lift(seff, FoldedLinearModel(model).eval(), inputs)
+    poses_optimized = lift(seff, optimized, inputs)
+
+    print(f"MPJPE folded vs fp32: {mpjpe(poses_folded, poses_fp32):.3f} mm")
+    print(f"MPJPE optimized vs fp32: {mpjpe(poses_optimized, poses_fp32):.3f} mm")
+
+    if args.targets is not None:
+        targets = np.load(args.targets).reshape(-1, 17, 3)
+        error_fp32 = mpjpe(poses_fp32, targets)
+        error_optimized = mpjpe(poses_optimized, targets)
+        print(f"MPJPE fp32: {error_fp32:.2f} mm, optimized: {error_optimized:.2f} mm, delta: {error_optimized - error_fp32:+.2f} mm")
+
+    for batch in (1, 8):
+        sample = torch.from_numpy(inputs[:batch])
+        print(f"Batch {batch}: fp32 {timeModel(model, sample)*1000:.3f} ms, optimized {timeModel(optimized, sample)*1000:.3f} ms")
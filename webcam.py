@@ -1,4 +1,4 @@
-from src.HydraPose import HydraPose, SEFFPOSE
+from src.HydraPose import HydraPose, SEFFPOSE, DROP_OLDEST
 import cv2
 
 hy = HydraPose(pose3D = SEFFPOSE)
@@ -6,9 +6,12 @@ cam = cv2.VideoCapture(0)
 
 hy.initWindow()
 
-while True:
+def grabFrame():
     ret, frame = cam.read()
+    return frame if ret else None
 
-    persons3D = hy.estimate3DPose(frame)
+def showFrame(packet):
+    hy.plotPersons(packet.color_img, block=False, persons2D=packet.persons2D, persons3D=packet.persons3D)
 
-    hy.plotPersons(frame, block=False)
+# Capture, detection, lifting and plotting overlap; stale frames are dropped
+hy.runPipeline(grabFrame, showFrame, policy=DROP_OLDEST)